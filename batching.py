@@ -0,0 +1,134 @@
+from collections import deque
+
+import numpy as np
+
+HISTOGRAM_BINS = 24
+
+
+def log2_bin(x):  #Histogram bin of a positive count: bin b holds [2^b, 2^(b+1))
+    return min(max(int(x).bit_length()-1, 0), HISTOGRAM_BINS-1)
+
+
+class BatchScheduler:  #Decides when a model's gatherer sends its pending evaluation requests to the runner as one batch
+    # A batch goes out when it reaches target_size rows, when its oldest request has waited latency_budget seconds, or when no live worker could still add to it:
+    # each is either waiting on it, or (given awaiting) waiting on a reply from one of the other_models, which are hosted by other processes.
+    # With tune set, target_size follows a fit of predict time = fixed_time + row_time*rows, made from the runner's timings
+    def __init__(self, num_workers, latency_budget=.01, target_size=1<<15, min_target=1, max_target=1<<15,
+                 overhead_fraction=.25, live_timeout=1., tune=True, decay=.99, min_timings=20, awaiting=None, other_models=0):
+        self.latency_budget = latency_budget
+        self.target_size = target_size
+        self.min_target = min_target
+        self.max_target = max_target
+        self.overhead_fraction = overhead_fraction  # Tuned batches are big enough that the fixed cost is at most this fraction of the per-row cost
+        self.live_timeout = live_timeout  # A worker counts as live if it sent anything this recently, in seconds
+        self.tune = tune
+        self.decay = decay  # Weight kept by older timings at each new one
+        self.min_timings = min_timings  # Timings needed before the first fit
+        self.awaiting = awaiting  # Per worker, a bitmask of the models it has a request out to, kept up to date by the workers in shared memory. None if unknown
+        self.other_models = other_models  # Bitmask of the models hosted elsewhere
+
+        self.arrivals = []  # [worker, rows, arrival time] for each pending request
+        self.waiting = set()  # Workers with a pending request. A worker has at most one per model, and waits on them together
+        self.pending_rows = 0
+        self.last_seen = np.full(num_workers, -np.inf)
+
+        self.fit_sums = np.zeros(5)  # Decayed sums of 1, rows, seconds, rows^2, rows*seconds
+        self.fixed_time = None
+        self.row_time = None
+
+        self.batch_size_histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)  # Batches, by log2 of their rows
+        self.queue_wait_histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)  # Requests, by log2 of their wait in microseconds
+        self.dispatch_reasons = {"size": 0, "latency": 0, "all waiting": 0}
+
+    def seen(self, worker, now):  #Any message from a worker shows that it is still playing
+        self.last_seen[worker] = now
+
+    def add(self, worker, rows, now):
+        self.seen(worker, now)
+        self.arrivals += [[worker, rows, now]]
+        self.waiting.add(worker)
+        self.pending_rows += rows
+
+    def live_workers(self, now):
+        return int(np.count_nonzero(self.last_seen >= now-self.live_timeout))
+
+    def free_workers(self, now):  #Live workers that could still send us a request: not waiting on us, nor on another model process
+        free = self.last_seen >= now-self.live_timeout
+        if self.awaiting is not None and self.other_models:
+            free &= (self.awaiting & self.other_models) == 0
+        free[list(self.waiting)] = False
+        return int(np.count_nonzero(free))
+
+    def dispatch_reason(self, now):  #Why the pending batch should go now, or None if it should wait
+        if len(self.arrivals) == 0:
+            return None
+        if self.pending_rows >= self.target_size:
+            return "size"
+        if now-self.arrivals[0][2] >= self.latency_budget:
+            return "latency"
+        if self.free_workers(now) == 0:
+            return "all waiting"
+        return None
+
+    def deadline(self):  #When the oldest pending request runs out of budget
+        return self.arrivals[0][2] + self.latency_budget
+
+    def dispatch(self, now, reason):  #The pending batch has been sent: record it and start a new one
+        self.dispatch_reasons[reason] += 1
+        self.batch_size_histogram[log2_bin(self.pending_rows)] += 1
+        for worker, rows, arrival in self.arrivals:
+            self.queue_wait_histogram[log2_bin((now-arrival)*10**6)] += 1
+        self.arrivals = []
+        self.waiting = set()
+        self.pending_rows = 0
+
+    def record_predict(self, rows, seconds):  #A timing from the runner, used to retune target_size
+        self.fit_sums *= self.decay
+        self.fit_sums += [1, rows, seconds, rows*rows, rows*seconds]
+        n, x, y, xx, xy = self.fit_sums
+        variance = n*xx - x*x
+        if n < min(self.min_timings, .5/(1-self.decay)) or variance <= 1e-9*n*xx:  # All batches so far were about the same size
+            return
+        self.row_time = (n*xy - x*y) / variance
+        self.fixed_time = (y - self.row_time*x) / n
+        if self.tune:
+            self.retune()
+
+    def retune(self):
+        if self.fixed_time <= 0 or self.row_time <= 0:  # Timing noise swamps the fit, so keep the current target
+            return
+        target = self.fixed_time / (self.overhead_fraction*self.row_time)
+        if self.latency_budget > self.fixed_time:  # Don't aim for batches that take longer than the budget to predict
+            target = min(target, (self.latency_budget-self.fixed_time) / self.row_time)
+        self.target_size = int(min(max(target, self.min_target), self.max_target))
+
+    def histograms(self):
+        return {"batch_size": self.batch_size_histogram.copy(), "queue_wait_us": self.queue_wait_histogram.copy(),
+                "dispatch_reasons": dict(self.dispatch_reasons)}
+
+    def summary(self):
+        def show(histogram):
+            return ", ".join("%d-%d: %d" % (2**b, 2**(b+1)-1, histogram[b]) for b in range(HISTOGRAM_BINS) if histogram[b])
+        fit = "no fit yet" if self.row_time is None else "predict time %.2f ms + %.2f us/row" % (self.fixed_time*1e3, self.row_time*1e6)
+        return ("target size %d rows, %s, dispatches by %s\n\tbatch sizes (rows): %s\n\tqueue waits (us): %s" %
+                (self.target_size, fit, self.dispatch_reasons, show(self.batch_size_histogram), show(self.queue_wait_histogram)))
+
+
+class PredictTimes:  #The runner's recent predict times for each padded batch size, for percentiles
+    def __init__(self, samples=4096):
+        self.samples = samples  # Times kept per bucket
+        self.times = {}
+        self.calls = {}
+
+    def record(self, bucket, seconds):
+        if bucket not in self.times:
+            self.times[bucket] = deque(maxlen=self.samples)
+            self.calls[bucket] = 0
+        self.times[bucket].append(seconds)
+        self.calls[bucket] += 1
+
+    def percentiles(self):  #Bucket: (calls, p50, p99), in seconds
+        return {b: (self.calls[b], float(np.percentile(self.times[b], 50)), float(np.percentile(self.times[b], 99))) for b in sorted(self.times)}
+
+    def summary(self):
+        return ", ".join("%d: %d calls, p50 %.2f ms, p99 %.2f ms" % (b, calls, p50*1e3, p99*1e3) for b, (calls, p50, p99) in self.percentiles().items())
@@ -0,0 +1,104 @@
+import os
+import sys
+import pickle
+import select
+from time import perf_counter
+
+import numpy as np
+
+from communication import CommunicationChannel
+
+# Compares CommunicationChannel with the pickling pipe channel it replaced, on the traffic main.py sends: a 35-candidate action evaluator request out, and its predictions back.
+# Usage: python channel_benchmark.py [round trips] [one-way messages]
+
+
+class PickledPipeChannel:  # The earlier CommunicationChannel protocol: each object pickled whole, behind an ASCII length read a byte at a time
+    def __init__(self):
+        self.info_out, self.info_in = os.pipe()
+
+    def write_message(self, tag, obj=None, request_id=0):
+        dump = pickle.dumps((tag, request_id, obj), -1)
+        os.write(self.info_in, (str(len(dump)) + " ").encode())
+        os.write(self.info_in, dump)
+
+    def write(self, obj):
+        self.write_message(None, obj)
+
+    def idle_until_data(self):
+        select.select([self.info_out], [], [])
+
+    def read_message(self):
+        length = '_'
+        while length[-1] != ' ':
+            length += os.read(self.info_out, 1).decode()
+        length = int(length[1:-1])
+        data = b''
+        while len(data) < length:
+            data += os.read(self.info_out, length-len(data))
+        return pickle.loads(data)
+
+    def read(self):
+        return self.read_message()[2]
+
+
+def example_request(rows=35):
+    return [np.random.rand(rows, 5).astype(np.float32),
+            np.random.rand(rows, 5).astype(np.float32),
+            np.random.rand(rows, 6, 5).astype(np.float32),
+            np.random.rand(rows, 6).astype(np.float32),
+            np.random.rand(rows, 6).astype(np.float32),
+            np.random.rand(rows, 5).astype(np.float32),
+            np.random.rand(rows, 7).astype(np.float32),
+            np.random.rand(rows, 5).astype(np.float32)]
+
+
+def echo_server(requests, replies):  # Answers each request with one prediction per row, until told to stop
+    while 1:
+        requests.idle_until_data()
+        ins, _, data = requests.read_message()
+        if ins == "q":
+            os._exit(0)
+        elif ins == "p":
+            replies.write(np.zeros((data[0].shape[0], 1), dtype=np.float32))
+        elif ins == "s":  # Drain a one-way stream, then acknowledge it
+            for i in range(data):
+                requests.idle_until_data()
+                requests.read()
+            replies.write("d")
+
+
+def benchmark(channel_class, round_trips, stream_messages):
+    requests, replies = channel_class(), channel_class()
+    pid = os.fork()
+    if pid == 0:
+        echo_server(requests, replies)
+
+    request = example_request()
+    latencies = np.zeros(round_trips)
+    for i in range(round_trips):
+        start = perf_counter()
+        requests.write_message("p", request)
+        replies.idle_until_data()
+        replies.read()
+        latencies[i] = perf_counter() - start
+
+    requests.write_message("s", stream_messages)
+    start = perf_counter()
+    for i in range(stream_messages):
+        requests.write(request)
+    replies.idle_until_data()
+    replies.read()
+    stream_time = perf_counter() - start
+
+    requests.write_message("q")
+    os.waitpid(pid, 0)
+    return latencies, stream_messages / stream_time
+
+
+if __name__ == "__main__":
+    round_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    stream_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    for channel_class in (PickledPipeChannel, CommunicationChannel):
+        latencies, rate = benchmark(channel_class, round_trips, stream_messages)
+        print("%-22s round trip: mean %6.1f us, p50 %6.1f us, p99 %6.1f us   one-way: %8.0f messages/s" % (
+            channel_class.__name__, latencies.mean()*1e6, np.percentile(latencies, 50)*1e6, np.percentile(latencies, 99)*1e6, rate))
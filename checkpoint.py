@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import glob
+import threading
+from time import perf_counter, time
+
+import numpy as np
+
+# Checkpoints of a model process's networks: one flat, uncompressed .npz per checkpoint, holding every hosted network's weights and optimizer state by model index, and a JSON manifest.
+# Each is written to a temp name and renamed into place, so any file with a checkpoint's name is complete. Names are <name>_step_<steps>.npz, name being the model process's (see main.py)
+
+
+def checkpoint_path(directory, name, steps):
+    return os.path.join(directory, name+"_step_"+str(steps)+".npz")
+
+
+def save_checkpoint(path, state, manifest):  #state: model index (or "unified" for the unified model's heads together): (weight arrays, optimizer arrays), as from models.ModelSet.get_state
+    arrays = {"manifest": np.array(json.dumps(manifest))}
+    for m, (weights, optimizer_weights) in state.items():
+        for i, w in enumerate(weights):
+            arrays["model_"+str(m)+"_weights_"+str(i)] = w
+        for i, w in enumerate(optimizer_weights):
+            arrays["model_"+str(m)+"_optimizer_"+str(i)] = w
+    with open(path+".tmp", "wb") as f:  # A file object, so savez doesn't add its own extension
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path+".tmp", path)
+
+
+def read_manifest(path):
+    with np.load(path) as f:
+        return json.loads(str(f["manifest"]))
+
+
+def load_checkpoint(path):  #Returns (state, manifest)
+    state = {}
+    with np.load(path) as f:
+        manifest = json.loads(str(f["manifest"]))
+        for m in manifest["model_indices"]:
+            prefix = "model_"+str(m)+"_"
+            weights = [f[prefix+"weights_"+str(i)] for i in range(len([n for n in f.files if n.startswith(prefix+"weights_")]))]
+            optimizer_weights = [f[prefix+"optimizer_"+str(i)] for i in range(len([n for n in f.files if n.startswith(prefix+"optimizer_")]))]
+            state[m] = (weights, optimizer_weights)
+    return state, manifest
+
+
+def list_checkpoints(directory, name):  #Paths of name's checkpoints in directory, newest (most steps) first
+    pattern = re.compile(re.escape(name)+r"_step_(\d+)\.npz$")
+    paths = []
+    for path in glob.glob(os.path.join(directory, name+"_step_*.npz")):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            paths += [(int(match.group(1)), path)]
+    return [path for steps, path in sorted(paths, reverse=True)]
+
+
+def latest_checkpoint(directory, name):  #The newest of name's checkpoints that reads back, or None
+    for path in list_checkpoints(directory, name):
+        try:
+            read_manifest(path)
+            return path
+        except Exception:  # Cut short by a full disk or the like: fall back to an older one
+            continue
+    return None
+
+
+class Checkpointer:  #Checkpoints a model process's networks every every_steps training steps or every_seconds seconds, whichever comes first, keeping the newest keep
+    # Getting the state has to happen on the thread that trains, but writing it out happens in a background thread, so training only waits for the copy
+    def __init__(self, directory, name, every_steps=1000, every_seconds=300, keep=3):
+        self.directory = directory
+        self.name = name
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.last_steps = None
+        self.last_time = perf_counter()
+        self.writer = None
+        self.saves = 0
+
+    def due(self, steps):
+        if self.last_steps is None:
+            self.last_steps = steps
+        return steps - self.last_steps >= self.every_steps or perf_counter() - self.last_time >= self.every_seconds
+
+    def maybe_save(self, model, steps, manifest):
+        if self.due(steps):
+            self.save(model, steps, manifest)
+
+    def save(self, model, steps, manifest, wait=False):  #manifest: anything else to record, such as games played
+        state = model.get_state()
+        manifest = dict(manifest, steps=steps, model_indices=sorted(state), time=time())
+        self.wait()  # At most one write at a time
+        self.writer = threading.Thread(target=self.write, args=(steps, state, manifest), daemon=True)
+        self.writer.start()
+        self.last_steps = steps
+        self.last_time = perf_counter()
+        if wait:
+            self.wait()
+
+    def write(self, steps, state, manifest):
+        save_checkpoint(checkpoint_path(self.directory, self.name, steps), state, manifest)
+        self.saves += 1
+        for path in list_checkpoints(self.directory, self.name)[self.keep:]:
+            os.remove(path)
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
@@ -1,15 +1,76 @@
 import os, select
 import pickle
+import struct
+import numpy as np
+
+# Every message is one frame: a fixed FRAME_HEADER, a small pickled skeleton of the object with each array replaced by its dtype and shape, then the raw contents of the arrays, so arrays are never pickled.
+# The tag is one character ("t", "p", ...), so a command and its data travel together. Plain write/read send a frame with no tag
+
+FRAME_HEADER = struct.Struct("<BIIIQ")  #Tag, request id, number of arrays, skeleton length, total array bytes
+
+def split_arrays(obj, arrays):
+    if type(obj) is np.ndarray and not obj.dtype.hasobject:
+        arrays += [obj if obj.flags.c_contiguous else np.ascontiguousarray(obj)]
+        return ("a", obj.dtype.str, obj.shape)
+    elif type(obj) is list or type(obj) is tuple:
+        return ("l" if type(obj) is list else "t", [split_arrays(x, arrays) for x in obj])
+    elif type(obj) is BroadcastBatch:
+        return ("b", split_arrays(obj.inputs, arrays), obj.shared, split_arrays(obj.row_groups, arrays))
+    return ("o", obj)
+
+DTYPES = {}  #np.dtype objects by their string, since building them is slow
+
+def join_arrays(skeleton, data, offset):  #offset is a one-element list, advanced past each array taken from data
+    kind = skeleton[0]
+    if kind == "a":
+        dtype = DTYPES.get(skeleton[1])
+        if dtype is None:
+            dtype = DTYPES[skeleton[1]] = np.dtype(skeleton[1])
+        arr = np.ndarray(skeleton[2], dtype, data, offset[0])
+        offset[0] += arr.nbytes
+        return arr
+    elif kind == "l":
+        return [join_arrays(x, data, offset) for x in skeleton[1]]
+    elif kind == "t":
+        return tuple([join_arrays(x, data, offset) for x in skeleton[1]])
+    elif kind == "b":
+        return BroadcastBatch(join_arrays(skeleton[1], data, offset), skeleton[2], join_arrays(skeleton[3], data, offset))
+    return skeleton[1]
+
+def encode_frame(tag, obj, request_id):  #The frame as a list of buffers, to be written in order
+    arrays = []
+    skeleton = pickle.dumps(split_arrays(obj, arrays), -1)
+    header = FRAME_HEADER.pack(ord(tag) if tag else 0, request_id, len(arrays), len(skeleton), sum(a.nbytes for a in arrays))
+    return [header, skeleton] + [memoryview(a).cast("B") for a in arrays if a.nbytes]
+
+def decode_frame(header, read_into):  #Returns (tag, request_id, obj). read_into(buffer) fills a buffer with the rest of the frame
+    tag, request_id, num_arrays, skeleton_length, data_length = FRAME_HEADER.unpack(header)
+    body = bytearray(skeleton_length + data_length)
+    read_into(body)
+    offset = [skeleton_length]
+    obj = join_arrays(pickle.loads(memoryview(body)[:skeleton_length]), body, offset)  #Arrays are views into the body, with no further copy
+    assert offset[0] == len(body)
+    return (chr(tag) if tag else None), request_id, obj
+
 
 class CommunicationChannel:  #A communication channel sends one object at a time, blocking until it is recieved. It can send objects bigger than the pipe limit.
     def __init__(self):
         self.info_out, self.info_in = os.pipe()
         self.poller = select.poll()
         self.poller.register(self.info_out, select.POLLIN)
+        self.header = bytearray(FRAME_HEADER.size)
+
+    def write_message(self, tag, obj=None, request_id=0):
+        parts = encode_frame(tag, obj, request_id)
+        written = os.writev(self.info_in, parts)
+        total = sum(len(p) for p in parts)
+        if written < total:  #Only if interrupted: send the rest the slow way
+            rest = memoryview(b"".join(parts))[written:]
+            while len(rest):
+                rest = rest[os.write(self.info_in, rest):]
+
     def write(self, obj):
-        dump = pickle.dumps(obj, -1)
-        os.write(self.info_in, (str(len(dump)) + " ").encode())
-        os.write(self.info_in, dump)
+        self.write_message(None, obj)
 
     def has_data(self):
         return (self.poller.poll(0)!=[])
@@ -18,20 +79,62 @@ class CommunicationChannel:  #A communication channel sends one object at a time
     def idle_until_data(self):
         self.poller.poll()
 
+    def fileno(self):
+        return self.info_out
+
+    def read_into(self, buffer):
+        view = memoryview(buffer)
+        done = 0
+        while done < len(view):
+            n = os.readv(self.info_out, [view[done:]])
+            if n == 0:
+                raise EOFError("Channel closed")
+            done += n
+
+    def read_message(self):
+        self.read_into(self.header)
+        return decode_frame(self.header, self.read_into)
+
     def read(self):
-        length = '_'
-        while length[-1]!=' ':
-            length += os.read(self.info_out, 1).decode()
-        length=int(length[1:-1])
-        data = b''
-        while len(data)<length:
-            data+=os.read(self.info_out, length-len(data))
-        return pickle.loads(data)
+        return self.read_message()[2]
 
     def __del__(self):
         os.close(self.info_in)
         os.close(self.info_out)
 
 
+class BroadcastBatch:  #Model inputs where most inputs are shared by a group of rows (one game state scored against several candidate actions). Shared inputs hold one row per group, and are only expanded when the batch is used, which keeps them small over a channel
+    def __init__(self, inputs, shared, row_groups):
+        self.inputs = inputs  # One array per model input
+        self.shared = shared  # Whether each input has one row per group rather than one per row
+        self.row_groups = row_groups  # The group each row belongs to
+
+    @classmethod
+    def single(cls, shared_inputs, row_inputs):  #One group: every row shares shared_inputs (each given without a leading axis)
+        num_rows = row_inputs[0].shape[0]
+        return cls([np.expand_dims(x, axis=0) for x in shared_inputs] + list(row_inputs),
+                   (True,)*len(shared_inputs) + (False,)*len(row_inputs),
+                   np.zeros(num_rows, dtype=np.uint8))
+
+    @classmethod
+    def concatenate(cls, batches):
+        row_groups = []
+        num_groups = 0
+        for b in batches:
+            row_groups += [b.row_groups.astype(np.int64) + num_groups]
+            num_groups += b.num_groups()
+        return cls([np.concatenate([b.inputs[i] for b in batches], axis=0) for i in range (len(batches[0].inputs))],
+                   batches[0].shared,
+                   np.concatenate(row_groups))
+
+    def num_rows(self):
+        return self.row_groups.shape[0]
+
+    def num_groups(self):
+        return int(self.row_groups.max())+1
 
+    def expand(self):  #The full per-row inputs, as a model takes them
+        return [x[self.row_groups] if s else x for x, s in zip(self.inputs, self.shared)]
 
+    def row(self, index):
+        return [x[self.row_groups[index]] if s else x[index] for x, s in zip(self.inputs, self.shared)]
@@ -0,0 +1,62 @@
+import argparse
+from time import perf_counter
+
+from numpy_models import save_inference_weights, load_inference_weights, quantize_weights, compare_precision, NumpyModelSet
+
+# Writes an inference-only copy of trained Keras weights: dropout stripped and the input scaling folded into the first Dense kernel, in a .npz that numpy_models loads without TensorFlow.
+# Usage: python export_inference.py WEIGHTS OUT.npz [--models 0 1 2 3 4 5] [--precision int8] [--validate TRAJECTORY_DIR]
+# WEIGHTS is any weights file main.py or offline_train.py saves: one model's, or with host_all_models, all six models' together. It can also be an earlier export, to requantize or validate it.
+# With --validate, each model's quantized predictions are compared to float32 on decisions logged by main.py with trajectory_dir set.
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export trained weights for NumPy inference")
+    parser.add_argument("weights", help="Keras weights file, or a .npz export")
+    parser.add_argument("out", help="Where to write the .npz")
+    parser.add_argument("--models", type=int, nargs="+", default=list(range(6)), help="Model indices the weights file holds, as it was saved")
+    parser.add_argument("--precision", default="float32", choices=["float32", "float16", "int8"], help="Precision to store kernels at")
+    parser.add_argument("--validate", default=None, help="Trajectory directory to measure the precision's accuracy delta on")
+    parser.add_argument("--validation-rows", type=int, default=1<<16, help="Most rows per model to validate on")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.weights.endswith(".npz"):
+        weights_by_model = load_inference_weights(args.weights)
+        weights_by_model = {m: weights_by_model[m] for m in args.models}
+    else:
+        import models
+        model = models.ModelSet(args.models)
+        model.load_weights(args.weights)
+        weights_by_model = {m: model.export_inference_weights(m) for m in args.models}
+    build_seconds = perf_counter() - start
+    save_inference_weights(args.out, {m: quantize_weights(w, args.precision) for m, w in weights_by_model.items()})
+
+    start = perf_counter()
+    NumpyModelSet(args.models).load_weights(args.out)
+    print("Exported models", args.models, "at", args.precision, "to", args.out)
+    print("Loading", args.weights, "took", build_seconds, "seconds, loading the export", perf_counter() - start)
+
+    if args.validate is not None:
+        from trajectories import read_index, load_shard
+        import numpy as np
+        for m in args.models:
+            xs = []
+            ys = []
+            rows = 0
+            for entry in read_index(args.validate, m):
+                if rows >= args.validation_rows:
+                    break
+                x, y = load_shard(args.validate, entry)
+                xs += [x]
+                ys += [y]
+                rows += y.shape[0]
+            if rows == 0:
+                print("Model", m, ": no logged decisions to validate on")
+                continue
+            x = [np.concatenate([a[i] for a in xs], axis=0)[:args.validation_rows] for i in range(len(xs[0]))]
+            y = np.concatenate(ys, axis=0)[:args.validation_rows]
+            print("Model", m, ":", compare_precision(weights_by_model[m], args.precision, x, y))
+
+
+if __name__ == "__main__":
+    main()
@@ -139,6 +139,9 @@ class CoupGame:
                 pin+=[i]
         return pin
 
+    def is_alive(self, player):
+        return self.hands[player]!=[]
+
     def shuffle(self):
         shuffle(self.deck)
 
@@ -148,4 +151,154 @@ class CoupGame:
         self.shuffle()
         self.hands[player]+=[self.draw_from_deck()]
 
+    def lose_card(self, player): #Discards the first card in the player's hand, returning it (or None if they have no cards left)
+        if self.hands[player]!=[]:
+            c=self.hands[player].pop(0)
+            self.discards+=[c]
+            return c
+
+    def exchange(self, player): #Exchanges cards. Currently random.
+        self.hands[player]+=[self.draw_from_deck(), self.draw_from_deck()]
+        shuffle(self.hands[player])
+        self.deck+=[self.hands[player].pop(0), self.hands[player].pop(1)]
+        self.hands[player]=self.hands[player][:2]
+        self.shuffle()
+
+
+def frozen(arr): #Marks an array read-only, so cached arrays can be handed out without copying
+    arr.setflags(write=False)
+    return arr
+
+
+class CompactCoupGame: #Drop-in for CoupGame with all state in fixed-size int8 arrays. Counters are kept up to date on every draw/replace/loss, so the accessors hand out cached arrays instead of recounting
+    __slots__ = ("num_players", "hand_slots", "hand_lengths", "hand_counts", "deck_counts", "deck_size", "discard_counts",
+                 "player_coins", "turn", "_hand_sizes", "_inplay", "_discards", "_one_hot_hands")
+
+    def __init__(self, num_players):
+        self.num_players=num_players
+        self.deck_counts=np.full(5, 3, dtype=np.int8)
+        self.deck_size=15
+        self.discard_counts=np.zeros(5, dtype=np.int8)
+        self.hand_slots=np.full((MAX_PLAYERS, 2), -1, dtype=np.int8) #Cards in hand order, -1 for an empty slot
+        self.hand_lengths=np.zeros(MAX_PLAYERS, dtype=np.int8)
+        self.hand_counts=np.zeros((MAX_PLAYERS, 5), dtype=np.int8)
+        self._one_hot_hands=[None]*MAX_PLAYERS
+        for i in range (0,num_players):
+            self.add_to_hand(i, self.draw_from_deck())
+            self.add_to_hand(i, self.draw_from_deck())
+        for i in range (0,MAX_PLAYERS):
+            self.hand_changed(i)
+        self.discards_changed()
+        self.turn=0
+
+        self.player_coins=np.array([2]*num_players+[0]*(MAX_PLAYERS-num_players), dtype=np.float32) #Kept as float32, since the training wrapper updates it in place and feeds it straight to the models
+
+    # The cached arrays below are rebuilt (never modified in place) whenever their counters change, so any array handed out earlier stays valid
+
+    def hand_changed(self, player):
+        self._one_hot_hands[player]=frozen(self.hand_counts[player].astype(np.float32))
+        self._hand_sizes=frozen(self.hand_lengths.astype(np.float32))
+
+    def discards_changed(self):
+        self._discards=frozen(self.discard_counts.astype(np.float32))
+        self._inplay=frozen(3-self._discards)
+
+    def draw_from_deck(self): #Every card left in the deck is equally likely, as in CoupGame
+        r=randint(0,self.deck_size-1)
+        card=0
+        while r>=self.deck_counts[card]:
+            r-=self.deck_counts[card]
+            card+=1
+        self.deck_counts[card]-=1
+        self.deck_size-=1
+        return card
+
+    def return_to_deck(self, card):
+        self.deck_counts[card]+=1
+        self.deck_size+=1
+
+    def add_to_hand(self, player, card):
+        self.hand_slots[player, self.hand_lengths[player]]=card
+        self.hand_lengths[player]+=1
+        self.hand_counts[player, card]+=1
+
+    def remove_from_hand(self, player, slot):
+        card=int(self.hand_slots[player, slot])
+        self.hand_slots[player, slot:-1]=self.hand_slots[player, slot+1:]
+        self.hand_slots[player, -1]=-1
+        self.hand_lengths[player]-=1
+        self.hand_counts[player, card]-=1
+        return card
+
+    @property
+    def hands(self): #List-of-lists view, for printing
+        return [[int(c) for c in self.hand_slots[i, :self.hand_lengths[i]]] for i in range (0,MAX_PLAYERS)]
+
+    @property
+    def deck(self):
+        return [c for c in range (0,5) for _ in range (0,self.deck_counts[c])]
+
+    @property
+    def discards(self):
+        return [c for c in range (0,5) for _ in range (0,self.discard_counts[c])]
+
+    def has_card(self, player, card):
+        return self.hand_counts[player, card]>0
+
+    def count_discards(self):
+        return self._discards
+
+    def count_inplay(self):
+        return self._inplay
+
+    def one_hot_hand(self,player):
+        return self._one_hot_hands[player]
+
+    def hand_sizes(self):
+        return self._hand_sizes
+
+    def is_alive(self, player):
+        return self.hand_lengths[player]>0
+
+    def next_turn(self):
+        self.turn += 1
+        self.turn %= MAX_PLAYERS
+        while self.hand_lengths[self.turn]==0:
+            self.turn += 1
+            self.turn %= MAX_PLAYERS
+
+    def players_in(self):
+        return [i for i in range (0,MAX_PLAYERS) if self.hand_lengths[i]>0]
+
+    def shuffle(self): #Draws are uniform over the counts, so there is no deck order to shuffle
+        pass
+
+    def replace(self, player, card):
+        slot=0
+        while self.hand_slots[player, slot]!=card:
+            slot+=1
+        self.remove_from_hand(player, slot)
+        self.return_to_deck(card)
+        self.add_to_hand(player, self.draw_from_deck())
+        self.hand_changed(player)
+
+    def lose_card(self, player):
+        if self.hand_lengths[player]>0:
+            c=self.remove_from_hand(player, 0)
+            self.discard_counts[c]+=1
+            self.hand_changed(player)
+            self.discards_changed()
+            return c
+
+    def exchange(self, player): #Same procedure as CoupGame.exchange
+        hand=self.hands[player]+[self.draw_from_deck(), self.draw_from_deck()]
+        shuffle(hand)
+        self.return_to_deck(hand.pop(0))
+        self.return_to_deck(hand.pop(1))
+        while self.hand_lengths[player]>0:
+            self.remove_from_hand(player, 0)
+        for c in hand[:2]:
+            self.add_to_hand(player, c)
+        self.hand_changed(player)
+
 
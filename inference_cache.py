@@ -0,0 +1,108 @@
+import hashlib
+from collections import OrderedDict
+from time import perf_counter
+
+import numpy as np
+
+from communication import BroadcastBatch
+
+
+class CachedEvaluator:  #An LRU cache of predictions in front of an evaluator, keyed on a hash of the request's inputs rounded to a quantum, leaving out the noise input
+    # Entries are evicted past max_entries, least recently used first, or once they are ttl seconds old. All of them are dropped when the evaluator reports new weights (its weights_step), which it learns with each reply.
+    # Training data and fit_predict calls always go through
+    def __init__(self, evaluator, noise_input=None, max_entries=4096, ttl=5., quantum=1e-3):
+        self.evaluator = evaluator
+        self.accepts_broadcast = getattr(evaluator, "accepts_broadcast", False)
+        self.noise_input = noise_input  # Index of the input to leave out of keys, None if there is none
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.quantum = quantum
+
+        self.entries = OrderedDict()  # Key: (prediction, time stored), least recently used first
+        self.weights_step = None  # Of the weights behind every entry
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.invalidations = 0
+
+    def key(self, x):
+        h = hashlib.blake2b(digest_size=16)
+        if isinstance(x, BroadcastBatch):
+            h.update(np.asarray(x.row_groups, dtype=np.int64).tobytes())
+            h.update(bytes(x.shared))
+            x = x.inputs
+        for i, a in enumerate(x):
+            if i != self.noise_input:
+                h.update(str(a.shape).encode())
+                h.update(np.round(np.asarray(a, dtype=np.float64) / self.quantum).astype(np.int64).tobytes())
+        return h.digest()
+
+    def lookup(self, key):
+        self.check_weights()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if perf_counter() - entry[1] > self.ttl:
+            del self.entries[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0].copy()  # Callers may write into their results
+
+    def check_weights(self):  #Drops every entry once the evaluator has heard of newer weights, which can be from a reply to an uncached request
+        weights_step = getattr(self.evaluator, "weights_step", None)
+        if weights_step != self.weights_step:  # Everything cached came from older weights
+            if len(self.entries) > 0:
+                self.invalidations += 1
+            self.entries.clear()
+            self.weights_step = weights_step
+
+    def store(self, key, result):
+        self.check_weights()
+        self.entries[key] = (result.copy(), perf_counter())
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def predict_async(self, x, **kwargs):
+        key = self.key(x)
+        result = self.lookup(key)
+        if result is not None:
+            return lambda: result
+        if getattr(self.evaluator, "predict_async", None) is None:
+            result = self.evaluator.predict(x)
+            self.store(key, result)
+            return lambda: result
+        pending = self.evaluator.predict_async(x)
+        def wait():
+            result = pending()
+            self.store(key, result)
+            return result
+        return wait
+
+    def predict(self, x, **kwargs):
+        return self.predict_async(x)()
+
+    def fit(self, x, y, **kwargs):
+        self.evaluator.fit(x, y, **kwargs)
+
+    def fit_predict(self, x, y, **kwargs):
+        return self.evaluator.fit_predict(x, y, **kwargs)
+
+    def refresh_weights(self):
+        self.evaluator.refresh_weights()
+
+    def get_weights(self):
+        return self.evaluator.get_weights()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / max(self.hits+self.misses, 1), "entries": len(self.entries),
+                "expired": self.expired, "evicted": self.evicted, "invalidations": self.invalidations}
+
+    def summary(self):
+        return ("%d hits, %d misses (hit rate %.3f), %d entries, %d expired, %d evicted, %d invalidations" %
+                (self.hits, self.misses, self.hits / max(self.hits+self.misses, 1), len(self.entries), self.expired, self.evicted, self.invalidations))
@@ -1,7 +1,9 @@
 import os
+import sys
+import mmap
 import numpy as np
 
-from communication import CommunicationChannel
+from communication import CommunicationChannel, BroadcastBatch
 
 from copy import deepcopy
 
@@ -22,13 +24,66 @@ games_per_thread = 1000000000  # Outdated
 runtime = 20 # In seconds
 num_threads = 256
 NUM_EVALUATORS = 6
-
+compact_game_state = True  # Play on game.CompactCoupGame rather than the list-based game.CoupGame
+defer_hand_updates = False  # Hold hand-predictor updates until the beliefs are read, sending their training data once per turn. Saves about 8% of predictor round trips, not the halving hoped for: each update's priors come from the previous update's predictions, so every update still needs its own predict
+local_inference = False  # Game workers run predictions themselves on NumPy copies of the weights, rather than through the model processes
+weight_refresh_games = 5  # With local_inference, how many games each worker plays between weight refreshes
+batch_latency_budget = .01  # Longest an evaluation request waits in a model's gatherer before its batch is sent, in seconds
+tune_batch_targets = True  # Also send batches once they reach a size tuned from measured predict times. See batching.BatchScheduler
+batch_stats = True  # Model gatherers print their batch size and queue wait histograms, and predict time percentiles, when they stop
+batch_buckets = [2**i for i in range(16)]  # Runners pad each model's batch up to the next of these sizes, so TensorFlow only ever sees a few shapes. None for no padding
+warmup_buckets = True  # Runners predict a batch of each bucket size before serving, so no request pays for first-run setup
+decoupled_training = True  # Each model fits in its own trainer process, while an inference replica keeps answering predictions with published weights
+host_all_models = False  # One model process hosts all six models.py networks in one TensorFlow session, rather than a process each. Implied by unified_model
+host_intra_op_threads = 0  # Thread pool sizes for the model processes' TensorFlow sessions, 0 leaving them to TensorFlow. A host's networks share them
+host_inter_op_threads = 0
+numpy_replicas = False  # With decoupled_training, runners serve with numpy_models.NumpyModel from inference-only exports the trainer publishes, and never load TensorFlow. Not with unified_model
+inference_precision = "float32"  # Kernels the trainer publishes for numpy_replicas and runners send to local_inference workers: "float32", "float16" or "int8" (about 4x smaller). NumpyModel widens them back to float32 as it loads them, so predicting is no faster and holds no less RAM, and picks up their rounding error. See numpy_models.quantize_weights and export_inference.py --validate
+unified_model = False  # One model process serves every decision from models.build_unified_models: a shared trunk with a head per model, predicted together for mixed requests. The heads share one optimizer, and checkpoints hold the trunk once. Not with local_inference
+weight_publish_steps = 8  # With decoupled_training, the trainer publishes its weights after this many gradient steps,
+weight_publish_interval = 5  # or once this many seconds have passed since the last publish, whichever comes first
+train_chunk_table = {  # Without decoupled_training, the runner fits in chunks of this many rows, serving predictions that arrive between chunks, so one waits for at most one chunk.
+    0: 4096,           # 4096 is the fit batch size, which leaves training unchanged. Smaller chunks take smaller gradient steps
+    1: 4096,
+    2: 4096,
+    3: 4096,
+    4: 4096,
+    5: 4096,
+}
+staging_ram_cap = 256 * 2**20  # Bytes of training data each model's gatherer holds in RAM while its trainer is busy. See staging.StagingBuffer
+staging_drop_oldest = False  # Past the cap, drop the oldest training data rather than spilling it to .npy shards on disk
+staging_spill_dir = None  # Where shards are spilled, None for the system temp directory
+train_submission_rows = 2**16  # Most rows sent to the trainer for one fit
+replay_capacity = 0  # Rows each model keeps for replay, in column files on disk, e.g. 2**20. See replay.ReplayBuffer. 0 fits each row once, as it arrives
+replay_ratio = 4  # With replay, rows sampled for training per row that arrives
+replay_prioritized = False  # Sample rows in proportion to how badly the model fit them when last sampled, rather than uniformly
+replay_dir = None  # Where the replay columns go, one subdirectory per model, kept and reopened by the next run. None for temp directories removed at exit
+trajectory_dir = None  # If set, every game worker logs all the training data it sends to compressed shards here, for offline_train.py. See trajectories.py
+trajectory_shard_rows = 2**15  # Rows per model in each trajectory shard
+inference_cache_entries = 0  # Predictions each game worker caches per model, keyed on inputs without the noise, so repeated states skip the model process. 0 for no cache. See inference_cache.CachedEvaluator
+inference_cache_ttl = 5  # Seconds a cached prediction is used for. Cached predictions are also dropped whenever a reply shows the weights have changed
+inference_cache_quantum = 1e-3  # Inputs are rounded to multiples of this for cache keys
+checkpoint_dir = None  # If set, model processes periodically checkpoint their networks' weights and optimizer state here, for --resume. See checkpoint.py
+checkpoint_steps = 1000  # Training steps between checkpoints,
+checkpoint_interval = 300  # or seconds, whichever comes first
+checkpoint_keep = 3  # Newest checkpoints kept for each model process
+resume = "--resume" in sys.argv[1:]  # Start each model process from its newest complete checkpoint in checkpoint_dir, and the workers' epsilon schedules from where they were
+
+
+hosted_together = unified_model or host_all_models  # Every model is served by one model process
+
+def process_name(hosted_models):  # Names a model process's weight files, checkpoints and stats
+    return "unified" if unified_model else "all" if hosted_together else str(hosted_models[0])
+
+awaiting_models = np.frombuffer(mmap.mmap(-1, num_threads+1), dtype=np.uint8)  # Per worker, bit m set while it has a request out to model m, so a gatherer can tell which workers are blocked on other model processes
+games_played = np.frombuffer(mmap.mmap(-1, 8*(num_threads+1)), dtype=np.int64)  # Games each worker has finished, in memory shared with every process forked below. The last slot holds the games played before a resume
 
 #Each thread has one pair of channels for each model: one to send data to it, one to receive data from it.
+#When the models are hosted together, each thread has one pair for all of them instead, and every message carries its model index as the request id in its header.
 thread_pipes = []
 for i in range (num_threads+1):
     thread_pipes += [[]]
-    for i in range (NUM_EVALUATORS):
+    for i in range (1 if hosted_together else NUM_EVALUATORS):
         thread_pipes[-1] += [[CommunicationChannel(), CommunicationChannel()]]
 
 
@@ -41,93 +96,234 @@ manager_pid = os.getpid()
 
 
 
-for i in range (NUM_EVALUATORS):
+model_groups = [list(range(NUM_EVALUATORS))] if hosted_together else [[i] for i in range(NUM_EVALUATORS)]  # The models each model process hosts
+assert not (unified_model and (local_inference or numpy_replicas)), "Unified model heads can't run in numpy_models.NumpyModel"
+assert decoupled_training or not numpy_replicas, "NumPy replicas can't train, so they need decoupled_training"
+resume_paths = {}  # Model process name: the checkpoint it starts from
+if resume:
+    assert checkpoint_dir is not None, "--resume needs checkpoint_dir"
+    import checkpoint
+    for group in model_groups:
+        path = checkpoint.latest_checkpoint(checkpoint_dir, process_name(group))
+        if path is not None:
+            resume_paths[process_name(group)] = path
+            games_played[num_threads] = max(games_played[num_threads], checkpoint.read_manifest(path)["games_played"])
+    print("Resuming from", sorted(resume_paths.values()), "after", games_played[num_threads], "games")
+for group in model_groups:
     model_pids+=[os.fork()]
     if model_pids[-1]==0:
         trainer_thread = True
-        model_index = len(model_pids) - 1
+        hosted_models = group
         break
 
 
 
 
-if trainer_thread:  # We fork every training thread into two components: scanner and evaluator
+if trainer_thread:  # We fork every training thread into components: the gatherer, the runner (evaluator, and trainer unless decoupled_training), and with decoupled_training the trainer
     import datetime
-    trainer_internal_pipes = [CommunicationChannel(), CommunicationChannel()]  # First is from the gatherer to the trainer, second is vice versa
-    thread_pipes = [i[model_index] for i in thread_pipes]
+    host_name = process_name(hosted_models)
+    trainer_internal_pipes = [CommunicationChannel(), CommunicationChannel()]  # First is from the gatherer to the runner, second is vice versa
     model_data_pipes = thread_pipes
+
+    def model_channels(worker, m):  # The channel pair a worker uses for model m
+        return model_data_pipes[worker][0 if hosted_together else m]
+    if decoupled_training:
+        import tempfile
+        trainer_pipes = [CommunicationChannel(), CommunicationChannel()]  # From the gatherer to the trainer, and vice versa
+        publish_channel = CommunicationChannel()  # The trainer announces each weight file it publishes to the runner, by its step count
+        weights_dir = tempfile.mkdtemp(prefix="coup_model_"+host_name+"_")
+        weights_path = os.path.join(weights_dir, "weights.npz" if numpy_replicas else "weights.h5")
+
+    import checkpoint
+    def make_checkpointer():
+        if checkpoint_dir is None:
+            return None
+        return checkpoint.Checkpointer(checkpoint_dir, host_name, every_steps=checkpoint_steps, every_seconds=checkpoint_interval, keep=checkpoint_keep)
+
+    def checkpoint_manifest():  # Where the run is, beyond the networks
+        games = int(games_played.sum())
+        return {"games_played": games, "epsilon_game_index": games // num_threads, "epsilon": .4*pow(.999, games // num_threads)}
+
+    def resume_state(model):  # Loads this process's checkpoint into model, if resuming. Returns the training steps it was taken at
+        if host_name not in resume_paths:
+            return 0
+        state, manifest = checkpoint.load_checkpoint(resume_paths[host_name])
+        model.set_state(state)
+        return manifest["steps"]
+
+    def save_exit(signum, frame):
+        datestr = str(datetime.datetime.now()).replace(" ", "_")[:-5]
+        os.makedirs("Model_Weights", exist_ok=True)
+        model.save_weights('Model_Weights/model_'+host_name+'_at_'+datestr+'.h5')
+        exit(0)
+
+    def make_replays():  # A replay buffer for each hosted model, or None for each without replay
+        if replay_capacity == 0:
+            return {m: None for m in hosted_models}
+        from replay import ReplayBuffer
+        return {m: ReplayBuffer(replay_capacity, directory=None if replay_dir is None else os.path.join(replay_dir, "model_"+str(m)),
+                                prioritized=replay_prioritized) for m in hosted_models}
+
+    def close_replays(replays):
+        for replay in replays.values():
+            if replay is not None:
+                replay.close()
+
+    def training_batches(model, model_index, replay, x, y, batch_size):  # The minibatches to train on for a submission, as (x, y, sample weights): the submission itself, in order, or with replay, samples of every row kept
+        if replay is None:
+            for start in range(0, y.shape[0], batch_size):
+                yield [a[start:start+batch_size] for a in x], y[start:start+batch_size], None
+            return
+        replay.append(x, y)
+        for i in range(-(-int(replay_ratio*y.shape[0]) // batch_size)):
+            batch_x, batch_y, indices, weights = replay.sample(min(batch_size, replay.size))
+            if replay.prioritized:  # Priorities come from the model's error on the rows just before it trains on them
+                prediction = model.predict({model_index: batch_x})[model_index]
+                replay.update_priorities(indices, np.abs(prediction.reshape(batch_y.shape[0], -1) - batch_y.reshape(batch_y.shape[0], -1)).mean(axis=1))
+            yield batch_x, batch_y, weights
+
     runner_pid = os.fork()
-    if runner_pid == 0:  #If we are the actual trainer/evaluator:
+    trainer_pid = os.fork() if decoupled_training and runner_pid != 0 else None
+    if runner_pid == 0:  #If we are the actual evaluator (and trainer, unless decoupled_training):
         import signal
-        import models
+        from time import perf_counter
+        from numpy_models import quantize_weights
 
-        model_index = len(model_pids) - 1
-        if model_index == 0:
-            model = models.get_action_evaluator()
-        elif model_index == 1:
-            model = models.get_block_evaluator(steal=False)
-        elif model_index == 2:
-            model = models.get_block_evaluator(steal=False)
-        elif model_index == 3:
-            model = models.get_block_evaluator(steal=True)
-        elif model_index == 4:
-            model = models.get_challenge_evaluator()
-        elif model_index == 5:
-            model = models.get_game_state_predictor()
+        if numpy_replicas:  # Serves from the trainer's inference-only exports, without TensorFlow
+            from numpy_models import NumpyModelSet
+            model = NumpyModelSet(hosted_models)
+            publish_channel.idle_until_data()  # There is nothing to serve with until the trainer's first export
         else:
-            raise RuntimeError("Too many models!")
-
-        def save_exit(signum, frame):
-            datestr = str(datetime.datetime.now()).replace(" ", "_")[:-5]
-            os.makedirs("Model_Weights", exist_ok=True)
-            model.save_weights('Model_Weights/model_'+str(model_index)+'_at_'+datestr+'.h5')
-            exit(0)
-        signal.signal(signal.SIGINT, save_exit)
-        signal.signal(signal.SIGTERM, save_exit)
+            import models
+            models.configure_session(host_intra_op_threads, host_inter_op_threads)
+            model = models.ModelSet(hosted_models, unified=unified_model, buckets=batch_buckets)
+        if warmup_buckets:
+            model.warmup()
+        weights_step = 0  # Gradient steps behind the weights we serve
+
+        if not decoupled_training:  # The trainer owns the weights worth saving otherwise
+            replays = make_replays()
+            weights_step = resume_state(model)
+            checkpointer = make_checkpointer()
+            def save_exit_runner(signum, frame):
+                close_replays(replays)
+                if checkpointer is not None:
+                    checkpointer.save(model, weights_step, checkpoint_manifest(), wait=True)
+                save_exit(signum, frame)
+            signal.signal(signal.SIGINT, save_exit_runner)
+            signal.signal(signal.SIGTERM, save_exit_runner)
+
+        def serve(ins, data):  # Answers a prediction ("e") or weights ("w") request
+            if ins == "w":  # Send the current weights to every worker that asked, for their local NumPy inference, at inference_precision
+                weights = {}
+                for owner, m in data:
+                    if m not in weights:
+                        weights[m] = quantize_weights(model.export_inference_weights(m), inference_precision)
+                    model_channels(owner, m)[1].write_message("r", (weights[m], weights_step), m)
+                trainer_internal_pipes[1].write_message("d")
+            else:  # Batches for any of the hosted models, which are predicted together
+                batch_models, batch_inputs, eval_owner_stacks = data
+                predict_start = perf_counter()
+                eval_results = model.predict(dict(zip(batch_models, batch_inputs)))
+                rows = 0
+                bucket = max(model.bucket(x[0].shape[0]) for x in batch_inputs)  # Of the largest padded batch, for the gatherer's predict time percentiles
+                for m, eval_owner_stack in zip(batch_models, eval_owner_stacks):
+                    eval_result = eval_results[m]
+                    stack_index = 0
+                    for i in range(len(eval_owner_stack)):
+                        model_channels(eval_owner_stack[i][0], m)[1].write_message("r",
+                            (eval_result[stack_index:stack_index + eval_owner_stack[i][1]], weights_step), m)
+                        stack_index += eval_owner_stack[i][1]
+                    assert stack_index == eval_result.shape[0]
+                    rows += stack_index
+                trainer_internal_pipes[1].write_message("d", (rows, perf_counter()-predict_start, weights_step, bucket))  # For the gatherer's batch scheduler and staleness stats
 
         while 1:
             trainer_internal_pipes[0].idle_until_data()
-            ins = trainer_internal_pipes[0].read()
-            if ins == "t":
-                data = trainer_internal_pipes[0].read()
-                model.fit(data[0], data[1], batch_size=4096, epochs=1, verbose=0, shuffle=False, )
+            if decoupled_training and publish_channel.has_data():  # Swap in the newest published weights before serving anything
+                while publish_channel.has_data():
+                    _, _, weights_step = publish_channel.read_message()
+                model.load_weights(weights_path)
+            ins, _, data = trainer_internal_pipes[0].read_message()
+            if ins == "t":  # Fit a chunk at a time, serving any request that arrives in between
+                m, x, y = data
+                preemptions = 0
+                longest_chunk = 0
+                chunk_start = perf_counter()
+                for batch_x, batch_y, weights in training_batches(model, m, replays[m], x, y, train_chunk_table[m]):
+                    model.train_on_batch(m, batch_x, batch_y, sample_weight=weights)
+                    longest_chunk = max(longest_chunk, perf_counter()-chunk_start)
+                    weights_step += 1
+                    if trainer_internal_pipes[0].has_data():
+                        preemptions += 1
+                        while trainer_internal_pipes[0].has_data():
+                            ins, _, data = trainer_internal_pipes[0].read_message()
+                            serve(ins, data)
+                    chunk_start = perf_counter()
+                trainer_internal_pipes[1].write_message("f", (preemptions, longest_chunk))
+                if checkpointer is not None:
+                    checkpointer.maybe_save(model, weights_step, checkpoint_manifest())
+            else:
+                serve(ins, data)
+
+    elif trainer_pid == 0:  # The trainer fits on everything the gatherer sends, publishing its weights to the runner by atomic file swap
+        import signal
+        import models
+        from time import perf_counter
+
+        models.configure_session(host_intra_op_threads, host_inter_op_threads)
+        model = models.ModelSet(hosted_models, unified=unified_model)
+        replays = make_replays()
+        steps = resume_state(model)
+        checkpointer = make_checkpointer()
+
+        def publish():
+            if numpy_replicas:
+                import numpy_models
+                numpy_models.save_inference_weights(weights_path + ".tmp.npz", {m: numpy_models.quantize_weights(model.export_inference_weights(m), inference_precision) for m in hosted_models})
+                os.replace(weights_path + ".tmp.npz", weights_path)  # The runner only ever sees a complete file
             else:
-                data, eval_owner_stack = trainer_internal_pipes[0].read()
-                eval_result = model.predict(data, verbose=0, batch_size=data[0].shape[0])
-                stack_index = 0
-                for i in range(len(eval_owner_stack)):
-                    model_data_pipes[eval_owner_stack[i][0]][1].write(
-                        eval_result[stack_index:stack_index + eval_owner_stack[i][1]] )
-                    stack_index += eval_owner_stack[i][1]
-                assert stack_index == eval_result.shape[0]
-            trainer_internal_pipes[1].write("d")
+                model.save_weights(weights_path + ".tmp.h5")
+                os.replace(weights_path + ".tmp.h5", weights_path)
+            publish_channel.write_message("n", steps)
+        publish()  # The runner starts from our initial weights
+        published_step = steps
+        published_time = perf_counter()
+
+        def save_exit_trainer(signum, frame):
+            close_replays(replays)
+            if checkpointer is not None:
+                checkpointer.save(model, steps, checkpoint_manifest(), wait=True)
+            save_exit(signum, frame)
+        signal.signal(signal.SIGINT, save_exit_trainer)
+        signal.signal(signal.SIGTERM, save_exit_trainer)
+
+        while 1:
+            trainer_pipes[0].idle_until_data()
+            ins, _, (m, x, y) = trainer_pipes[0].read_message()
+            for batch_x, batch_y, weights in training_batches(model, m, replays[m], x, y, 4096):
+                model.train_on_batch(m, batch_x, batch_y, sample_weight=weights)
+                steps += 1
+            if steps - published_step >= weight_publish_steps or perf_counter() - published_time >= weight_publish_interval:
+                publish()
+                published_step = steps
+                published_time = perf_counter()
+            trainer_pipes[1].write_message("d", steps)
+            if checkpointer is not None:
+                checkpointer.maybe_save(model, steps, checkpoint_manifest())
 
     else:
         import signal
-        from time import perf_counter, time_ns
+        import selectors
+        from time import perf_counter
+        from batching import BatchScheduler, PredictTimes
+        from staging import StagingBuffer
         last_eval_time = perf_counter()
+        last_parent_check = perf_counter()
 
 
         num_pipes = len(model_data_pipes)
 
-        min_length_table = {  # The sum of these must be less than the total number of threads
-            0: 25,  # This and 5 may want to be changed
-            1: 4,  # 4
-            2: 4,  # 4
-            3: 4,  # 4
-            4: 5,  # 2
-            5: 25,
-        }
-
-        min_length_table_2 = {  # The sum of these must be less than the total number of threads
-            0: 25,  # This and 5 may want to be changed
-            1: 4,  # 4
-            2: 4,  # 4
-            3: 4,  # 4
-            4: 5,  # 2
-            5: 25,
-        }
-
         min_train_table = {
             0: 2048,
             1: 512,
@@ -137,113 +333,241 @@ if trainer_thread:  # We fork every training thread into two components: scanner
             5: 2048,
         }
 
-        eval_stack = []
-        eval_owner_stack = []
-        training_data_x = []
-        training_data_y = []
-
-        training_samples = 0
-
-        can_send = True
-
-        train_cycle_time = 1*10**7  # In nanoseconds
-        last_division = time_ns()-time_ns()%train_cycle_time
+        eval_stacks = {m: [] for m in hosted_models}  # Pending evaluation inputs for each hosted model, and who they are for
+        eval_owner_stacks = {m: [] for m in hosted_models}
+        weight_requests = []
+        staging = {m: StagingBuffer(staging_ram_cap, spill_dir=staging_spill_dir, drop_oldest=staging_drop_oldest) for m in hosted_models}  # Training data, until the trainer is free
+
+        runner_free = True
+        trainer_free = True  # Only used with decoupled_training: otherwise training goes to the runner, when it is free
+        runner_training = False  # Without decoupled_training, whether the runner is part way through a fit. It still takes requests between chunks
+        fits = 0
+        fit_preemptions = 0
+        longest_chunk = 0
+        train_channel = trainer_pipes[0] if decoupled_training else trainer_internal_pipes[0]
+
+        scheduler = BatchScheduler(num_pipes, latency_budget=batch_latency_budget, tune=tune_batch_targets,  # Over every hosted model's requests, since they are predicted together
+                                   awaiting=awaiting_models, other_models=sum(1 << m for m in range(NUM_EVALUATORS) if m not in hosted_models))
+        predict_times = PredictTimes()
+        trainer_steps = 0
+        staleness_total = 0  # Over every batch served: how many gradient steps the served weights were behind the trainer
+        staleness_max = 0
+        batches_served = 0
 
         def die_cleanly(signum, frame):
             os.kill(runner_pid, 15)
+            if decoupled_training:
+                os.kill(trainer_pid, 15)
+                import shutil
+                shutil.rmtree(weights_dir, ignore_errors=True)
+                print("Model", host_name, "weights: trainer at", trainer_steps, "steps, mean staleness",
+                      staleness_total / max(batches_served, 1), "steps, max", staleness_max)
+            else:
+                print("Model", host_name, "training:", fits, "fits, preempted", fit_preemptions, "times, longest chunk", longest_chunk*1000, "ms")
+            if batch_stats:
+                print("Model", host_name, "batching:", scheduler.summary())
+                print("Model", host_name, "predict times by bucket (rows):", predict_times.summary())
+            for m in hosted_models:
+                print("Model", m, "staging:", staging[m].summary())
+                staging[m].close()
             exit(0)
         signal.signal(signal.SIGINT, die_cleanly)
         signal.signal(signal.SIGTERM, die_cleanly)
+
+        # The gatherer sleeps in one epoll wait on every worker channel and the runner's return pipe, and only wakes for a message or the scheduler's deadline
+        selector = selectors.DefaultSelector()
+        for i in range(num_pipes):
+            for m in (hosted_models[:1] if hosted_together else hosted_models):
+                selector.register(model_channels(i, m)[0].fileno(), selectors.EVENT_READ, (i, m))
+        selector.register(trainer_internal_pipes[1].fileno(), selectors.EVENT_READ, "runner")
+        if decoupled_training:
+            selector.register(trainer_pipes[1].fileno(), selectors.EVENT_READ, "trainer")
+        try:  # A pidfd becomes readable when the parent exits. Without one, check on the parent every parent_check_time seconds
+            parent_fd = os.pidfd_open(manager_pid)
+            selector.register(parent_fd, selectors.EVENT_READ, "parent")
+        except (AttributeError, OSError):
+            parent_fd = None
+        parent_check_time = 1
+
         while 1:
-            for i in range(num_pipes):
-                if model_data_pipes[i][0].has_data():
-                    ins = model_data_pipes[i][0].read()
-                    if ins == "t":  # If the data is training data, add it to the stacks
-                        data = model_data_pipes[i][0].read()
-                        training_data_x += [data[0]]
-                        training_data_y += [data[1]]
-                        training_samples += data[1].shape[0]
-                    elif ins == "p":
-                        data = model_data_pipes[i][0].read()  # It's evaluation data
-                        eval_stack += [data]
-                        eval_owner_stack += [[i, data[0].shape[0]]]
-                    else:  # We must both fit to and predict on this data
-                        data = model_data_pipes[i][0].read()
-                        eval_stack += [data[0]]
-                        eval_owner_stack += [[i, data[0][0].shape[0]]]
-                        training_data_x += [data[0]]
-                        training_data_y += [data[1]]
-                        training_samples += data[1].shape[0]
-
-                if can_send:
-                    if len(eval_owner_stack) > 0 and time_ns()-last_division >= train_cycle_time:  # and (model_index != 5 or len(eval_owner_stack)>40):
-                        last_division = (time_ns() // train_cycle_time) * train_cycle_time
-                        last_eval_time=perf_counter()
-                        model_in = []
-                        for d in range(len(eval_stack[0])):
-                            model_in += [np.concatenate([e[d] for e in eval_stack], axis=0)]
-                        trainer_internal_pipes[0].write("e")
-                        trainer_internal_pipes[0].write((model_in, eval_owner_stack))
-
-                        eval_stack = []
-                        del model_in
-                        eval_owner_stack = []
-
-                        can_send = False
-                    elif (training_samples > min_train_table[model_index]):
-                        train_in = []
-                        for d in range(len(training_data_x[0])):
-                            train_in += [np.concatenate([e[d] for e in training_data_x], axis=0)]
-                        train_out = np.concatenate(training_data_y, axis=0)
-
-                        trainer_internal_pipes[0].write("t")
-                        trainer_internal_pipes[0].write((train_in, train_out))
-                        training_data_x = []
-                        training_data_y = []
-                        del train_in
-                        del train_out
-                        training_samples = 0
-                        can_send = False
-
-                else:
-                    if trainer_internal_pipes[1].has_data():
-                        trainer_internal_pipes[1].read()
-                        can_send = True
-
-
-
-
-            try:  # If the parent isn't running, die.
-                os.kill(manager_pid, 0)
-            except:
-                die_cleanly(0,0)
+            timeout = None
+            if runner_free and len(scheduler.arrivals) > 0:
+                timeout = max(0, scheduler.deadline() - perf_counter())
+            if parent_fd is None:
+                timeout = parent_check_time if timeout is None else min(timeout, parent_check_time)
+
+            for key, events in selector.select(timeout):
+                if key.data == "parent":
+                    die_cleanly(0,0)
+                elif key.data == "runner":
+                    tag, _, timing = trainer_internal_pipes[1].read_message()
+                    if tag == "f":  # A fit has finished
+                        fits += 1
+                        fit_preemptions += timing[0]
+                        longest_chunk = max(longest_chunk, timing[1])
+                        runner_training = False
+                        continue
+                    if timing is not None:
+                        rows, seconds, weights_step, bucket = timing
+                        scheduler.record_predict(rows, seconds)
+                        predict_times.record(bucket, seconds)
+                        if decoupled_training:
+                            staleness = max(trainer_steps - weights_step, 0)
+                            staleness_total += staleness
+                            staleness_max = max(staleness_max, staleness)
+                            batches_served += 1
+                    runner_free = True
+                    continue
+                elif key.data == "trainer":
+                    _, _, trainer_steps = trainer_pipes[1].read_message()
+                    trainer_free = True
+                    continue
+                i, m = key.data
+                ins, request_id, data = model_channels(i, m)[0].read_message()
+                if hosted_together:
+                    m = request_id
+                now = perf_counter()
+                if ins == "t":  # If the data is training data, stage it for the trainer
+                    staging[m].add(data[0], data[1])
+                    scheduler.seen(i, now)
+                elif ins == "w":  # A worker wants the current weights
+                    weight_requests += [(i, m)]
+                    scheduler.seen(i, now)
+                elif ins == "p":  # It's evaluation data
+                    if isinstance(data, BroadcastBatch):  # Shared context is only expanded to one row per candidate here
+                        data = data.expand()
+                    eval_stacks[m] += [data]
+                    eval_owner_stacks[m] += [[i, data[0].shape[0]]]
+                    scheduler.add(i, data[0].shape[0], now)
+                else:  # We must both fit to and predict on this data
+                    eval_stacks[m] += [data[0]]
+                    eval_owner_stacks[m] += [[i, data[0][0].shape[0]]]
+                    scheduler.add(i, data[0][0].shape[0], now)
+                    staging[m].add(data[0], data[1])
+
+            if runner_free:
+                now = perf_counter()
+                reason = scheduler.dispatch_reason(now)
+                if reason is not None:
+                    scheduler.dispatch(now, reason)
+                    last_eval_time = now
+                    batch_models = [m for m in hosted_models if len(eval_stacks[m]) > 0]
+                    model_in = []
+                    for m in batch_models:
+                        model_in += [[np.concatenate([e[d] for e in eval_stacks[m]], axis=0) for d in range(len(eval_stacks[m][0]))]]
+                    trainer_internal_pipes[0].write_message("e", (batch_models, model_in, [eval_owner_stacks[m] for m in batch_models]))
+
+                    for m in batch_models:
+                        eval_stacks[m] = []
+                        eval_owner_stacks[m] = []
+                    del model_in
+
+                    runner_free = False
+                elif len(weight_requests) > 0:
+                    trainer_internal_pipes[0].write_message("w", weight_requests)
+                    weight_requests = []
+                    runner_free = False
+
+            if (trainer_free if decoupled_training else runner_free and not runner_training):
+                ready = [m for m in hosted_models if staging[m].num_rows > min_train_table[m]]
+                if len(ready) > 0:
+                    m = max(ready, key=lambda m: staging[m].num_rows)  # The model with the most waiting goes first
+                    train_in, train_out = staging[m].take(train_submission_rows)
+
+                    train_channel.write_message("t", (m, train_in, train_out))
+                    del train_in
+                    del train_out
+                    if decoupled_training:
+                        trainer_free = False
+                    else:
+                        runner_training = True
+
+            if parent_fd is None and perf_counter() - last_parent_check >= parent_check_time:
+                last_parent_check = perf_counter()
+                try:  # If the parent isn't running, die.
+                    os.kill(manager_pid, 0)
+                except:
+                    die_cleanly(0,0)
 
 
 
 
 else: #If we are not a trainer thread, we are still the top thread: set up game threads now.
     from signal import signal, SIGINT, SIGTERM
+    from collections import deque
     class ModelRequestWrapper:
-        def __init__(self, eval_in_channel, eval_out_channel):
+        accepts_broadcast = True  # BroadcastBatch inputs are sent compact and expanded by the gatherer
+
+        def __init__(self, eval_in_channel, eval_out_channel, model_index=0, replies=None):
             self.eval_in_channel = eval_in_channel
             self.eval_out_channel = eval_out_channel
+            self.model_index = model_index  # Sent in each message's header, for a host to route it by
+            self.replies = replies  # With channels shared by every model's wrapper, replies read for any model, by model index, until their wrapper wants them. None if the channels are this model's own
+            self.weights_step = None  # Of the weights behind the latest reply
+
+        def request(self, ins, data):  # Sends a request that gets a reply, marking this worker as waiting on the model until receive
+            awaiting_models[my_index] |= 1 << self.model_index
+            self.eval_in_channel.write_message(ins, data, self.model_index)
+
+        def receive(self):  # Replies come with the step of the weights that made them
+            if self.replies is None:
+                self.eval_out_channel.idle_until_data()
+                result, self.weights_step = self.eval_out_channel.read()
+            else:
+                while len(self.replies[self.model_index]) == 0:  # The reply may come after replies to other models' requests
+                    self.eval_out_channel.idle_until_data()
+                    _, m, obj = self.eval_out_channel.read_message()
+                    self.replies[m].append(obj)
+                result, self.weights_step = self.replies[self.model_index].popleft()
+            awaiting_models[my_index] &= ~(1 << self.model_index) & 0xff
+            return result
 
         def fit(self, x, y, **kwargs):
-            self.eval_in_channel.write("t")
-            self.eval_in_channel.write((x, y))
+            self.eval_in_channel.write_message("t", (x, y), self.model_index)
 
-        def predict(self, x, **kwargs):
+        def predict_async(self, x, **kwargs):  # Sends the request straight away; the returned function waits for the result
             #print("Started request")
-            self.eval_in_channel.write("p")
-            self.eval_in_channel.write(x)
-            self.eval_out_channel.idle_until_data()
-            return self.eval_out_channel.read()
+            self.request("p", x)
+            return self.receive
+
+        def predict(self, x, **kwargs):
+            return self.predict_async(x)()
+
+        def fit_predict(self, x, y, **kwargs):
+            self.request("b", (x,y))
+            return self.receive()
+
+        def get_weights(self):  # The model's current weights, as exported by models.export_inference_weights
+            self.request("w", None)
+            return self.receive()
+
+    def make_evaluators(pipes):  # A ModelRequestWrapper for each model, over a thread's channels
+        if hosted_together:
+            replies = {i: deque() for i in range(NUM_EVALUATORS)}
+            return [ModelRequestWrapper(pipes[0][0], pipes[0][1], i, replies) for i in range(NUM_EVALUATORS)]
+        return [ModelRequestWrapper(pipes[i][0], pipes[i][1], i) for i in range(NUM_EVALUATORS)]
+
+    class LocalInferenceWrapper:  # Runs predictions in this process with numpy_models.NumpyModel, while training data still goes to the model process
+        accepts_broadcast = True
+
+        def __init__(self, remote):
+            self.remote = remote
+            self.local = NumpyModel()
+            self.refresh_weights()
+
+        def refresh_weights(self):
+            self.local.set_weights(self.remote.get_weights())  # Already at inference_precision
+            self.weights_step = self.remote.weights_step
+
+        def fit(self, x, y, **kwargs):
+            self.remote.fit(x, y)
+
+        def predict(self, x, **kwargs):
+            return self.local.predict(x)
 
         def fit_predict(self, x, y, **kwargs):
-            self.eval_in_channel.write("b")
-            self.eval_in_channel.write((x,y))
-            self.eval_out_channel.idle_until_data()
-            return self.eval_out_channel.read()
+            self.remote.fit(x, y)
+            return self.local.predict(x)
 
     from os import write, read, pipe
     game_count_out, game_count_in = pipe()
@@ -265,27 +589,51 @@ else: #If we are not a trainer thread, we are still the top thread: set up game
         start_time = perf_counter()
         last_eval_time = perf_counter()
         import train
-        evaluators = []
-        for i in range (NUM_EVALUATORS): #Generate the five evaluators. They will communicate with the parent process for direction
-            evaluators += [ModelRequestWrapper(my_pipes[i][0], my_pipes[i][1])]
+        evaluators = make_evaluators(my_pipes)  # Generate the evaluators. They will communicate with the model processes for direction
+        if local_inference:
+            from numpy_models import NumpyModel
+            evaluators = [LocalInferenceWrapper(e) for e in evaluators]
+        if inference_cache_entries > 0:
+            from inference_cache import CachedEvaluator
+            evaluators = [CachedEvaluator(e, noise_input=None if i == 5 else 5, max_entries=inference_cache_entries, ttl=inference_cache_ttl,  # Every model but the hand predictor takes noise as its sixth input
+                                          quantum=inference_cache_quantum) for i, e in enumerate(evaluators)]
         action_evaluator, assassin_block_evaluator, aid_block_evaluator, captain_block_evaluator, challenge_evaluator, game_state_evaluator = evaluators #Map them in
-
-
-        for i in range (games_per_thread):
+        trajectory_writer = None
+        if trajectory_dir is not None:
+            from trajectories import ShardWriter
+            trajectory_writer = ShardWriter(trajectory_dir, my_index, rows_per_shard=trajectory_shard_rows)
+
+        def stop_worker():
+            if trajectory_writer is not None:
+                trajectory_writer.close()
+            if inference_cache_entries > 0 and my_index == 0:
+                for m in range(NUM_EVALUATORS):
+                    print("Worker", my_index, "cache for model", m, ":", evaluators[m].summary())
+            os._exit(0)
+
+
+        queue_peak = 0
+        for i in range (int(games_played[num_threads]) // num_threads, games_per_thread):  # Resumed runs carry on the epsilon schedule
             eps = .4*pow(.999, i)
             if my_index==16:
-                print("Playing game", i, "with epsilon", eps, " . Time for previous hand:", perf_counter()-last_eval_time)
+                print("Playing game", i, "with epsilon", eps, " . Time for previous hand:", perf_counter()-last_eval_time, " . Peak training queue bytes:", queue_peak)
                 last_eval_time=perf_counter()
             trainer = train.GameTrainingWrapper(5, action_evaluator, assassin_block_evaluator, aid_block_evaluator,
                                                 captain_block_evaluator, challenge_evaluator, game_state_evaluator,
-                                                q_epsilon=eps, verbose=False)
+                                                q_epsilon=eps, verbose=False, compact_state=compact_game_state,
+                                                defer_hand_updates=defer_hand_updates, trajectory_writer=trajectory_writer)
             game_continuing = True
             while game_continuing:
                 game_continuing = trainer.take_turn()
                 if perf_counter()-start_time > runtime:
-                    os._exit(0)
+                    stop_worker()
+            queue_peak = trainer.queue_memory_high_water()
+            games_played[my_index] += 1
             trainer.train_all_evaluators(verbose=0)  # Indent this for more frequent training
-        os._exit(0)
+            if local_inference and (i+1) % weight_refresh_games == 0:
+                for e in evaluators:
+                    e.refresh_weights()
+        stop_worker()
 
 
     else:  # If we are the central supervisory process, wait for all game-playing threads to terminate.
@@ -303,9 +651,7 @@ else: #If we are not a trainer thread, we are still the top thread: set up game
 
         print("Playing example game...")
 
-        evaluators = []
-        for i in range(NUM_EVALUATORS):  # Generate the evaluators. They will communicate with the parent process for direction
-            evaluators += [ModelRequestWrapper(my_pipes[i][0], my_pipes[i][1])]
+        evaluators = make_evaluators(my_pipes)  # Generate the evaluators. They will communicate with the model processes for direction
         action_evaluator, assassin_block_evaluator, aid_block_evaluator, captain_block_evaluator, challenge_evaluator, game_state_evaluator = evaluators  # Map them in
 
         import train
@@ -8,9 +8,11 @@ from keras import backend as K
 K.set_floatx('float32')
 
 import tensorflow as tf
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-K.tensorflow_backend.set_session(tf.Session(config=config))
+def configure_session(intra_op_threads=0, inter_op_threads=0): #Replaces the Keras session with one whose thread pools have these sizes, 0 leaving them to TensorFlow. Networks must be built after it
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)  # Independent networks in one session.run run side by side in the inter-op pool
+    config.gpu_options.allow_growth = True
+    K.tensorflow_backend.set_session(tf.Session(config=config))
+configure_session()
 
 
 
@@ -81,6 +83,8 @@ def get_game_state_predictor(): #Generate a network to predict state of cards in
                              outputs=stackLayers(layers))
     net.compile(optimizer=keras.optimizers.Adam(.001), loss='mse', metrics=['accuracy'])
     net._make_predict_function()
+    net.input_scales = (1, 1, 1/2, 1/10, 1, 1)
+    net.output_scale = 2.0
     return net
 
 def get_action_evaluator():#Generates a network to decide the value of an action, given game state.    May want to make it a conv 1d net for the prior probability input
@@ -133,6 +137,8 @@ def get_action_evaluator():#Generates a network to decide the value of an action
                              outputs=stackLayers(layers))
     net.compile(optimizer=keras.optimizers.Adam(.001), loss='mse', metrics=['accuracy'])
     net._make_predict_function()
+    net.input_scales = (1, 1, 1, 1/2, 1/10, 1, 1, 1)
+    net.output_scale = 1.0
     return net
 
 def get_block_evaluator(steal): #Generates reward evaluator for a specific blocking action. Set steal=true iff that action is stealing
@@ -174,6 +180,8 @@ def get_block_evaluator(steal): #Generates reward evaluator for a specific block
                              outputs=stackLayers(layers))
     net.compile(optimizer=keras.optimizers.Adam(.001), loss='mse', metrics=['accuracy'])
     net._make_predict_function()
+    net.input_scales = (1, 1, 1, 1/2, 1/10, 1, 1)
+    net.output_scale = 1.0
     return net
 
 
@@ -224,30 +232,202 @@ def get_challenge_evaluator(): #Generates reward evaluator for challenges.
                              outputs=stackLayers(layers))
     net.compile(optimizer=keras.optimizers.Adam(.001), loss='mse', metrics=['accuracy'])
     net._make_predict_function()
+    net.input_scales = (1, 1, 1, 1/2, 1/10, 1, 1, 1)
+    net.output_scale = 1.0
     return net
 
 
+def build_model(model_index): #The network served under each model index in main.py
+    if model_index == 0:
+        return get_action_evaluator()
+    elif model_index == 1:
+        return get_block_evaluator(steal=False)
+    elif model_index == 2:
+        return get_block_evaluator(steal=False)
+    elif model_index == 3:
+        return get_block_evaluator(steal=True)
+    elif model_index == 4:
+        return get_challenge_evaluator()
+    elif model_index == 5:
+        return get_game_state_predictor()
+    raise RuntimeError("Too many models!")
+
+
+# Every network above is its inputs, each scaled by a Lambda and flattened, concatenated in input order, then a stack of Dense layers (Dropout does nothing at inference) and an optional output Lambda.
+# The builders record those scales as net.input_scales and net.output_scale, so the weights can be exported for numpy_models.NumpyModel.
+
+def export_inference_weights(net):
+    dense_layers = [l for l in net.layers if isinstance(l, Dense)]
+    return {
+        "input_sizes": [int(np.prod(K.int_shape(x)[1:])) for x in net.inputs],
+        "input_scales": list(net.input_scales),
+        "kernels": [l.get_weights()[0] for l in dense_layers],
+        "biases": [l.get_weights()[1] for l in dense_layers],
+        "activations": [l.get_config()["activation"] for l in dense_layers],
+        "output_scale": net.output_scale,
+    }
+
+
+# The unified model: one network for every decision, with a shared trunk over the game context they all see (undiscarded cards, priors, hand sizes and coins) and a head per model index.
+# Each head takes exactly the inputs of the separate network it replaces, so train.py builds the same input lists for it. Training a head through train_on_batch also trains the trunk
+
+class SharedAdam(keras.optimizers.Adam): #Adam that keeps one pair of moments per variable, however many models it is compiled into, so heads sharing the trunk share its moments and step count
+    # Keras's Adam makes new moments in every get_updates call, so each model compiled with one instance would keep its own for the same variables. Ignores decay and amsgrad
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.moments = {}  # Variable name: (m, v), in the order the variables were first seen, which fixes the order of get_weights
+
+    def get_updates(self, loss, params):
+        grads = self.get_gradients(loss, params)
+        self.updates = [K.update_add(self.iterations, 1)]
+        t = K.cast(self.iterations, K.floatx()) + 1
+        lr_t = self.lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+        for p, g in zip(params, grads):
+            if p.name not in self.moments:
+                self.moments[p.name] = (K.zeros(K.int_shape(p), dtype=K.dtype(p)), K.zeros(K.int_shape(p), dtype=K.dtype(p)))
+            m, v = self.moments[p.name]
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+            self.updates += [K.update(m, m_t), K.update(v, v_t), K.update(p, p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon))]
+        self.weights = [self.iterations] + [w for pair in self.moments.values() for w in pair]
+        return self.updates
+
+
+def build_unified_models(): #Returns the six heads, as Keras models sharing the trunk's layers, in model index order
+    trunk = [
+        Dense(128, activation='relu'),
+        Dropout(.3),
+        Dense(128, activation='relu'),
+        Dropout(.3),
+    ]
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def context_inputs():
+        return Input(shape=(5,)), Input(shape=(6,5)), Input(shape=(6,)), Input(shape=(6,))  # Undiscarded cards, priors, cards and coins per player
+
+    def trunk_features(undiscarded_cards, prior_probability_input, num_cards, num_coins):
+        return stackLayers([keras.layers.concatenate([undiscarded_cards,
+                                                      Flatten()(prior_probability_input),
+                                                      Lambda(lambda x: x / 2)(num_cards),
+                                                      Lambda(lambda x: x / 10)(num_coins)])] + trunk)
+
+    def head(features, hidden, outputs):
+        layers = [keras.layers.concatenate(features)]
+        for size in hidden:
+            layers += [Dense(size, activation='relu'), Dropout(.3)]
+        return stackLayers(layers + outputs)
+
+    def evaluator_head(decision_inputs, hidden): #Inputs are (undiscarded cards, our cards, priors, num cards, num coins, noise) and then the decision's own, as in the separate evaluators
+        undiscarded_cards, prior_probability_input, num_cards, num_coins = context_inputs()
+        our_actual_cards = Input(shape=(5,))
+        random_noise = Input(shape=(5,))
+        features = trunk_features(undiscarded_cards, prior_probability_input, num_cards, num_coins)
+        return keras.models.Model(inputs=(undiscarded_cards, our_actual_cards, prior_probability_input, num_cards, num_coins, random_noise) + decision_inputs,
+                                  outputs=head([features, our_actual_cards, random_noise] + list(decision_inputs), hidden, [Dense(1, activation='sigmoid')]))
+
+    def game_state_head():
+        undiscarded_cards, prior_probability_input, num_cards, num_coins = context_inputs()
+        action_input = Input(shape=(game.NUM_ACTIONS,))
+        target_input = Input(shape=(game.MAX_PLAYERS-1,))
+        features = trunk_features(undiscarded_cards, prior_probability_input, num_cards, num_coins)
+        return keras.models.Model(inputs=(undiscarded_cards, prior_probability_input, num_cards, num_coins, action_input, target_input),
+                                  outputs=head([features, action_input, target_input], (64, 32, 16), [Dense(5, activation='sigmoid'), Lambda(lambda x: x * 2.0)]))
+
+    nets = [
+        evaluator_head((Input(shape=(game.NUM_ACTIVE_ACTIONS,)), Input(shape=(game.MAX_PLAYERS-1,))), (64, 32, 8)),
+        evaluator_head((Input(shape=(1,)),), (32, 8)),
+        evaluator_head((Input(shape=(1,)),), (32, 8)),
+        evaluator_head((Input(shape=(2,)),), (32, 8)),
+        evaluator_head((Input(shape=(game.NUM_CHALLENGABLE_ACTIONS,)), Input(shape=(1,))), (64, 8)),
+        game_state_head(),
+    ]
+    optimizer = SharedAdam(.001)  # One set of moments and one step count for the trunk, whichever head trains it
+    for net in nets:
+        net.compile(optimizer=optimizer, loss='mse', metrics=['accuracy'])
+        net.input_scales = None  # The trunk only sees some inputs, which NumpyModel can't represent
+    for net in nets:
+        net._make_train_function()  # Creates the moments in model index order, so the optimizer's weights are in the same order in every process
+    return nets
+
+
+class ModelSet: #The networks one model process hosts, by model index. Predictions for any of them run together in one session.run, through a prebuilt function rather than predict()
+    def __init__(self, model_indices, unified=False, buckets=None):  #With buckets, each network's batch is padded to the next bucket size, so TensorFlow only sees those shapes
+        self.model_indices = list(model_indices)
+        self.buckets = None if buckets is None else sorted(buckets)
+        self.unified = unified
+        if unified:
+            heads = build_unified_models()
+            self.nets = {i: heads[i] for i in self.model_indices}
+        else:
+            self.nets = {i: build_model(i) for i in self.model_indices}
+        self.predict_function = None  # Over every network: one function, so no subset of them is ever a first run
+        self.absent_inputs = {}  # Zero inputs of the smallest bucket, for the networks a call doesn't predict for
+        if len(self.model_indices) == 1:  # Weight files are the same as the network's own
+            self.saved = self.nets[self.model_indices[0]]
+        else:  # One model over every network, so their weights are saved and loaded together. Shared layers are saved once
+            self.saved = keras.models.Model(inputs=[x for i in self.model_indices for x in self.nets[i].inputs],
+                                            outputs=[self.nets[i].outputs[0] for i in self.model_indices])
+
+    def bucket(self, rows): #The batch size rows are padded to. Past the largest bucket, a multiple of it
+        if self.buckets is None:
+            return rows
+        for b in self.buckets:
+            if b >= rows:
+                return b
+        return -(-rows // self.buckets[-1]) * self.buckets[-1]
+
+    def predict(self, batches): #batches maps model indices to input lists. Returns their predictions the same way
+        if self.predict_function is None:
+            self.predict_function = K.function([x for i in self.model_indices for x in self.nets[i].inputs] + [K.learning_phase()],
+                                               [self.nets[i].outputs[0] for i in self.model_indices])
+        inputs = []
+        rows = {}
+        for i in self.model_indices:
+            if i not in batches:
+                if i not in self.absent_inputs:
+                    self.absent_inputs[i] = [np.zeros((self.bucket(1),)+K.int_shape(x)[1:], dtype=np.float32) for x in self.nets[i].inputs]
+                inputs += self.absent_inputs[i]
+                continue
+            rows[i] = batches[i][0].shape[0]
+            padded = self.bucket(rows[i])
+            for x in batches[i]:
+                if padded > rows[i]:  # Padding rows are zeros, and their predictions are dropped
+                    x = np.concatenate([x, np.zeros((padded-rows[i],)+x.shape[1:], dtype=x.dtype)], axis=0)
+                inputs += [x]
+        results = self.predict_function(inputs + [0])
+        return {i: r[:rows[i]] for i, r in zip(self.model_indices, results) if i in batches}
+
+    def warmup(self): #Predicts a batch of each bucket size with every network. Each network's layers only see its own batch, so this covers every shape a call can give them
+        for b in (self.buckets or []):
+            self.predict({i: [np.zeros((b,)+K.int_shape(x)[1:], dtype=np.float32) for x in self.nets[i].inputs] for i in self.model_indices})
+
+    def train_on_batch(self, model_index, x, y, sample_weight=None):
+        return self.nets[model_index].train_on_batch(x, y, sample_weight=sample_weight)
+
+    def get_state(self): #Weights and optimizer state of every network, by model index, as lists of arrays, for checkpoint.py
+        if self.unified:  # The heads share the trunk and the optimizer, so they are saved once, together
+            return {"unified": (self.saved.get_weights(), self.nets[self.model_indices[0]].optimizer.get_weights())}
+        return {i: (self.nets[i].get_weights(), self.nets[i].optimizer.get_weights()) for i in self.model_indices}
+
+    def set_state(self, state):
+        if self.unified:
+            weights, optimizer_weights = state["unified"]
+            self.saved.set_weights(weights)
+            if len(optimizer_weights) > 0:  # build_unified_models already made the optimizer's weights
+                self.nets[self.model_indices[0]].optimizer.set_weights(optimizer_weights)
+            return
+        for i in self.model_indices:
+            weights, optimizer_weights = state[i]
+            self.nets[i].set_weights(weights)
+            if len(optimizer_weights) > 0:
+                self.nets[i]._make_train_function()  # Creates the optimizer's weights, so they can be set
+                self.nets[i].optimizer.set_weights(optimizer_weights)
+
+    def save_weights(self, path):
+        self.saved.save_weights(path)
+
+    def load_weights(self, path):
+        self.saved.load_weights(path)
+
+    def export_inference_weights(self, model_index):
+        assert self.nets[model_index].input_scales is not None, "Unified model heads can't be exported for NumpyModel"
+        return export_inference_weights(self.nets[model_index])
@@ -0,0 +1,179 @@
+import numpy as np
+
+from communication import BroadcastBatch
+
+
+KERNEL_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "sigmoid": lambda x: np.reciprocal(1 + np.exp(-x, out=x), out=x),  # Overflow to inf in exp still gives the right limit
+    "linear": lambda x: x,
+}
+
+
+class NumpyModel:  # Forward pass of a network from models.py in plain NumPy, from the weights given by models.export_inference_weights. Has no Keras or TensorFlow dependency, so game workers can run it themselves
+    accepts_broadcast = True  # Inputs shared across rows only go through the first layer once per group
+
+    def __init__(self, weights=None):
+        if weights is not None:
+            self.set_weights(weights)
+
+    def set_weights(self, weights):  # Kernels quantized to float16 or int8 are widened to float32 here, once: NumPy has no fast matmul for them
+        weights = dequantize_weights(weights)
+        first_kernel = np.asarray(weights["kernels"][0], dtype=np.float32)
+        offsets = np.cumsum([0] + list(weights["input_sizes"]))
+        # The first kernel is split into the rows fed by each input, with that input's scaling folded in
+        self.input_kernels = [first_kernel[offsets[i]:offsets[i+1]] * np.float32(weights["input_scales"][i]) for i in range(len(weights["input_sizes"]))]
+        self.kernels = [None] + [np.asarray(k, dtype=np.float32) for k in weights["kernels"][1:]]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in weights["biases"]]
+        self.activations = [ACTIVATIONS[a] for a in weights["activations"]]
+        self.output_scale = np.float32(weights["output_scale"])
+
+    def first_layer(self, x):
+        if isinstance(x, BroadcastBatch):
+            per_group = np.zeros((x.num_groups(), self.biases[0].shape[0]), dtype=np.float32) + self.biases[0]
+            per_row = 0
+            for i in range(len(x.inputs)):
+                part = np.asarray(x.inputs[i], dtype=np.float32).reshape(x.inputs[i].shape[0], -1) @ self.input_kernels[i]
+                if x.shared[i]:
+                    per_group += part
+                else:
+                    per_row = per_row + part
+            return per_group[x.row_groups] + per_row
+        h = self.biases[0]
+        for i in range(len(x)):
+            h = h + np.asarray(x[i], dtype=np.float32).reshape(x[i].shape[0], -1) @ self.input_kernels[i]
+        return h
+
+    def predict(self, x, **kwargs):
+        with np.errstate(over="ignore"):
+            return self.forward(x)
+
+    def forward(self, x):
+        h = self.activations[0](self.first_layer(x))
+        for i in range(1, len(self.kernels)):
+            h = self.activations[i](h @ self.kernels[i] + self.biases[i])
+        if self.output_scale != 1:
+            h *= self.output_scale
+        return h
+
+
+# Inference-only weight files: one .npz holding the exported weights of any number of models, by model index, with each input's scaling folded into the first kernel.
+# Loading one needs only NumPy, so an inference replica starts without building or compiling a Keras model.
+
+def dequantize_weights(weights):  #The same network with float32 kernels
+    if "kernel_scales" not in weights and all(np.asarray(k).dtype == np.float32 for k in weights["kernels"]):
+        return weights
+    scales = weights.get("kernel_scales", [1] * len(weights["kernels"]))
+    dequantized = dict(weights)
+    dequantized["kernels"] = [np.asarray(k).astype(np.float32) * np.float32(s) for k, s in zip(weights["kernels"], scales)]
+    dequantized.pop("kernel_scales", None)
+    return dequantized
+
+
+def fold_input_scales(weights):  #The same network, with its input scales multiplied into the rows of the first kernel they feed
+    if all(s == 1 for s in weights["input_scales"]):
+        return weights
+    weights = dequantize_weights(weights)
+    scales = np.repeat(np.asarray(weights["input_scales"], dtype=np.float32), weights["input_sizes"])
+    folded = dict(weights)
+    folded["kernels"] = [weights["kernels"][0] * scales[:, None]] + weights["kernels"][1:]
+    folded["input_scales"] = [1] * len(weights["input_sizes"])
+    return folded
+
+
+def weights_precision(weights):  #The precision quantize_weights stored weights' kernels at, None if it didn't store them
+    if "kernel_scales" in weights:
+        return "int8"
+    for precision in ("float32", "float16"):
+        if all(np.asarray(k).dtype == KERNEL_DTYPES[precision] for k in weights["kernels"]):
+            return precision
+    return None
+
+
+def quantize_weights(weights, precision):  #The same network with its kernels stored as precision: "float32", "float16", or "int8" with one scale per layer, its largest weight mapping to 127. Biases stay float32
+    if weights_precision(weights) == precision and all(s == 1 for s in weights["input_scales"]):  # Already quantized, e.g. a replica passing on what it loaded
+        return weights
+    weights = fold_input_scales(dequantize_weights(weights))
+    if precision == "float32":
+        return weights
+    quantized = dict(weights)
+    if precision == "int8":
+        quantized["kernel_scales"] = [float(np.abs(k).max()) / 127 or 1. for k in weights["kernels"]]
+        quantized["kernels"] = [np.round(k / np.float32(s)).astype(np.int8) for k, s in zip(weights["kernels"], quantized["kernel_scales"])]
+    else:
+        quantized["kernels"] = [k.astype(KERNEL_DTYPES[precision]) for k in weights["kernels"]]
+    return quantized
+
+
+def compare_precision(weights, precision, x, y):  #How the quantized network's predictions on inputs x differ from float32, and how each fits targets y
+    exact = NumpyModel(quantize_weights(weights, "float32")).predict(x)
+    approximate = NumpyModel(quantize_weights(weights, precision)).predict(x)
+    y = np.asarray(y, dtype=np.float32).reshape(exact.shape)
+    return {"rows": exact.shape[0], "mean_abs_delta": float(np.abs(approximate-exact).mean()), "max_abs_delta": float(np.abs(approximate-exact).max()),
+            "float32_mse": float(((exact-y)**2).mean()), precision+"_mse": float(((approximate-y)**2).mean()),
+            "kernel_bytes": sum(k.nbytes for k in quantize_weights(weights, precision)["kernels"]),
+            "float32_kernel_bytes": sum(k.nbytes for k in quantize_weights(weights, "float32")["kernels"])}
+
+
+def save_inference_weights(path, weights_by_model):  #weights_by_model maps model indices to weights from models.export_inference_weights
+    arrays = {}
+    for m, weights in weights_by_model.items():
+        weights = fold_input_scales(weights)
+        prefix = "model_"+str(m)+"_"
+        arrays[prefix+"input_sizes"] = np.asarray(weights["input_sizes"], dtype=np.int64)
+        arrays[prefix+"activations"] = np.asarray(weights["activations"])
+        arrays[prefix+"output_scale"] = np.float32(weights["output_scale"])
+        for i in range(len(weights["kernels"])):
+            arrays[prefix+"kernel_"+str(i)] = weights["kernels"][i]
+            arrays[prefix+"bias_"+str(i)] = np.asarray(weights["biases"][i], dtype=np.float32)
+        if "kernel_scales" in weights:
+            arrays[prefix+"kernel_scales"] = np.asarray(weights["kernel_scales"], dtype=np.float32)
+    with open(path, "wb") as f:  # A file object, so savez doesn't add its own extension
+        np.savez(f, **arrays)
+
+
+def load_inference_weights(path):  #Model index: weights, in the form NumpyModel.set_weights takes
+    weights_by_model = {}
+    with np.load(path) as f:
+        for name in f.files:
+            if name.endswith("_input_sizes"):
+                prefix = name[:-len("input_sizes")]
+                layers = len([n for n in f.files if n.startswith(prefix+"bias_")])
+                weights_by_model[int(prefix.split("_")[1])] = {
+                    "input_sizes": [int(s) for s in f[prefix+"input_sizes"]],
+                    "input_scales": [1] * len(f[prefix+"input_sizes"]),
+                    "kernels": [f[prefix+"kernel_"+str(i)] for i in range(layers)],
+                    "biases": [f[prefix+"bias_"+str(i)] for i in range(layers)],
+                    "activations": [str(a) for a in f[prefix+"activations"]],
+                    "output_scale": float(f[prefix+"output_scale"]),
+                }
+                if prefix+"kernel_scales" in f.files:
+                    weights_by_model[int(prefix.split("_")[1])]["kernel_scales"] = [float(s) for s in f[prefix+"kernel_scales"]]
+    return weights_by_model
+
+
+class NumpyModelSet:  #Stands in for models.ModelSet in an inference replica: the same serving interface, over NumpyModels loaded from save_inference_weights files
+    def __init__(self, model_indices):
+        self.model_indices = list(model_indices)
+        self.weights = {}  # As loaded, at whatever precision the file holds them
+        self.nets = {}
+
+    def load_weights(self, path):
+        weights_by_model = load_inference_weights(path)
+        for m in self.model_indices:
+            self.weights[m] = weights_by_model[m]
+            self.nets[m] = NumpyModel(weights_by_model[m])
+
+    def bucket(self, rows):  # NumPy has no per-shape setup, so batches aren't padded
+        return rows
+
+    def warmup(self):
+        pass
+
+    def predict(self, batches):
+        return {m: self.nets[m].predict(x) for m, x in batches.items()}
+
+    def export_inference_weights(self, model_index):
+        return self.weights[model_index]
@@ -0,0 +1,58 @@
+import os
+import argparse
+from time import perf_counter
+
+from trajectories import read_index, stream_batches
+
+# Trains one of the models.py networks on trajectory shards logged by main.py (with trajectory_dir set), without playing any games.
+# Usage: python offline_train.py TRAJECTORY_DIR MODEL_INDEX [--epochs N] [--batch-size N] [--threads N] [--init WEIGHTS.h5] [--out WEIGHTS.h5] [--unified]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a model offline from logged self-play trajectories")
+    parser.add_argument("directory", help="Directory of trajectory shards and their index files")
+    parser.add_argument("model_index", type=int, help="Model to train, as numbered by models.build_model")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=4, help="Shard reader threads")
+    parser.add_argument("--prefetch", type=int, default=8, help="Most loaded shards waiting to be trained on")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--init", default=None, help="Weights to start from, rather than a fresh network")
+    parser.add_argument("--out", default=None, help="Where to save the trained weights")
+    parser.add_argument("--report-every", type=int, default=100, help="Batches between progress reports")
+    parser.add_argument("--unified", action="store_true", help="Train the model's head of models.build_unified_models, loading and saving the weights of every head")
+    args = parser.parse_args()
+
+    entries = read_index(args.directory, args.model_index)
+    total_rows = sum(e["rows"] for e in entries)
+    print("Model", args.model_index, ":", len(entries), "shards,", total_rows, "rows")
+    if total_rows == 0:
+        return
+
+    import models
+    model = models.ModelSet(range(6) if args.unified else [args.model_index], unified=args.unified)
+    if args.init is not None:
+        model.load_weights(args.init)
+
+    start = perf_counter()
+    rows = 0
+    batches = 0
+    for x, y in stream_batches(args.directory, args.model_index, args.batch_size, epochs=args.epochs,
+                               num_threads=args.threads, prefetch_shards=args.prefetch, seed=args.seed):
+        loss = model.train_on_batch(args.model_index, x, y)
+        rows += y.shape[0]
+        batches += 1
+        if batches % args.report_every == 0:
+            print("Batch", batches, "rows", rows, "of", total_rows*args.epochs, "loss", loss, "rows/s", rows/(perf_counter()-start))
+    print("Trained on", rows, "rows in", batches, "batches,", perf_counter()-start, "seconds")
+
+    out = args.out
+    if out is None:
+        os.makedirs("Model_Weights", exist_ok=True)
+        out = "Model_Weights/model_"+("unified" if args.unified else str(args.model_index))+"_offline.h5"
+    model.save_weights(out)
+    print("Saved weights to", out)
+
+
+if __name__ == "__main__":
+    main()
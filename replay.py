@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+
+class SumTree:  #Priorities of capacity slots, in a binary tree of partial sums, for sampling slots in proportion to their priority
+    def __init__(self, capacity):
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        self.tree = np.zeros(2*self.leaves)  # Node i has children 2i and 2i+1. Leaves start at self.leaves
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[self.leaves + indices]
+
+    def set(self, indices, priorities):
+        if len(indices) == 0:  # nodes[0] below needs a node
+            return
+        nodes = self.leaves + np.asarray(indices)
+        self.tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes+1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):  #The slot whose priority interval holds each value in [0, total)
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = self.tree[2*nodes]
+            right = values >= left
+            values -= left*right
+            nodes = 2*nodes + right
+        return nodes - self.leaves
+
+
+class ReplayBuffer:  #Training rows for one model, kept in fixed-schema column files on disk, one per model input plus one for targets
+    # Rows are written in a ring, so appends cost the same however full the store is, and the oldest rows are overwritten past capacity.
+    # Minibatches are gathered from memmaps of the columns, so only the sampled rows are read into RAM.
+    # With a directory, the columns persist there and are reopened by the next ReplayBuffer made on it; otherwise they go in a temp directory removed by close()
+    # A persistent store is flushed by close() and by the first append every flush_interval seconds. After a crash it reopens as of the last flush, rows appended since having overwritten some older ones
+    def __init__(self, capacity, directory=None, prioritized=False, alpha=.6, beta=.4, seed=None, flush_interval=60.):
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.alpha = alpha  # How strongly priorities skew sampling: 0 is uniform
+        self.beta = beta  # How much importance weights undo that skew: 1 fully
+        self.rng = np.random.RandomState(seed)
+        self.persistent = directory is not None
+        self.directory = directory if self.persistent else tempfile.mkdtemp(prefix="coup_replay_")
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.columns = None  # Memmaps of shape (capacity,) + row shape, the targets last. Made by the first append, which fixes the schema
+        self.size = 0
+        self.next_index = 0
+        self.appended = 0  # Rows ever appended
+        self.tree = SumTree(capacity) if prioritized else None
+        self.max_priority = 1.
+        self.flush_interval = flush_interval
+        self.last_flush = perf_counter()
+        if os.path.exists(self.meta_path()):
+            self.reopen()
+
+    def meta_path(self):
+        return os.path.join(self.directory, "replay.json")
+
+    def column_path(self, i):
+        return os.path.join(self.directory, "column_"+str(i)+".npy")
+
+    def reopen(self):
+        with open(self.meta_path()) as f:
+            meta = json.load(f)
+        assert meta["capacity"] == self.capacity, "Replay capacity differs from the stored columns"
+        self.columns = [np.load(self.column_path(i), mmap_mode="r+") for i in range(meta["num_columns"])]
+        self.size = meta["size"]
+        self.next_index = meta["next_index"]
+        self.appended = meta["appended"]
+        if self.prioritized:
+            if os.path.exists(os.path.join(self.directory, "priorities.npy")):
+                priorities = np.load(os.path.join(self.directory, "priorities.npy"))
+            else:
+                priorities = np.ones(self.capacity)
+            self.tree.set(np.arange(self.size), priorities[:self.size])
+            self.max_priority = max(priorities[:self.size].max(initial=0), 1.)
+
+    def append(self, x, y):
+        columns = list(x) + [y]
+        n = y.shape[0]
+        if n > self.capacity:  # Only the newest rows would survive
+            columns = [c[n-self.capacity:] for c in columns]
+            n = self.capacity
+        if self.columns is None:
+            self.columns = [np.lib.format.open_memmap(self.column_path(i), mode="w+", dtype=c.dtype, shape=(self.capacity,)+c.shape[1:])
+                            for i, c in enumerate(columns)]
+        first = min(n, self.capacity-self.next_index)  # Rows before the ring wraps
+        for column, c in zip(self.columns, columns):
+            column[self.next_index:self.next_index+first] = c[:first]
+            column[:n-first] = c[first:]
+        if self.prioritized:
+            self.tree.set((self.next_index + np.arange(n)) % self.capacity, self.max_priority)  # New rows are sampled soon
+        self.next_index = (self.next_index+n) % self.capacity
+        self.size = min(self.size+n, self.capacity)
+        self.appended += n
+        if self.persistent and perf_counter() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def sample(self, batch_size):  #Returns (x, y, indices, importance weights) for batch_size rows, drawn with replacement. Weights are None without prioritized
+        if self.prioritized:
+            values = (self.rng.random_sample(batch_size) + np.arange(batch_size)) * (self.tree.total()/batch_size)  # One draw from each of batch_size equal strata
+            indices = np.minimum(self.tree.find(values), self.size-1)
+        else:
+            indices = self.rng.randint(0, self.size, batch_size)
+        indices.sort()  # Reads the memmaps in file order
+        rows = [column[indices] for column in self.columns]
+        weights = None
+        if self.prioritized:
+            probabilities = self.tree.get(indices) / self.tree.total()
+            weights = (self.size*probabilities) ** -self.beta
+            weights = (weights / weights.max()).astype(np.float32)
+        return rows[:-1], rows[-1], indices, weights
+
+    def update_priorities(self, indices, errors):  #errors: how badly the model fits each sampled row, as returned by sample
+        if len(indices) == 0:
+            return
+        priorities = (np.abs(errors) + 1e-6) ** self.alpha
+        self.tree.set(indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def flush(self):  #Writes everything needed to reopen the columns
+        if self.columns is None:
+            return
+        for column in self.columns:
+            column.flush()
+        if self.prioritized:
+            np.save(os.path.join(self.directory, "priorities.npy"), self.tree.get(np.arange(self.capacity)))
+        with open(self.meta_path()+".tmp", "w") as f:  # Renamed into place, so a crash mid-flush leaves the last one
+            json.dump({"capacity": self.capacity, "num_columns": len(self.columns), "size": self.size,
+                       "next_index": self.next_index, "appended": self.appended}, f)
+        os.replace(self.meta_path()+".tmp", self.meta_path())
+        self.last_flush = perf_counter()
+
+    def close(self):
+        if self.persistent:
+            self.flush()
+        self.columns = None
+        if not self.persistent:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from collections import deque
+
+import numpy as np
+
+
+class StagingBuffer:  #Training data waiting for a busy trainer, kept in arrival order, with capped RAM use
+    # Past ram_cap bytes, everything held in RAM is written out as one shard of .npy files and read back through memmaps when its turn comes.
+    # With drop_oldest, the oldest rows are dropped instead, and nothing touches the disk.
+    # Spilled shards always come before the rows in RAM, since a spill takes all of them
+    def __init__(self, ram_cap, spill_dir=None, drop_oldest=False):  #Shards go in a new directory inside spill_dir (by default the system temp directory), removed by close()
+        self.ram_cap = ram_cap
+        self.drop_oldest = drop_oldest
+        self.spill_dir = None if drop_oldest else tempfile.mkdtemp(prefix="coup_staging_", dir=spill_dir)
+
+        self.entries = deque()  # [x, y, shard paths or None if in RAM] for each submission or shard, oldest first
+        self.num_rows = 0
+        self.ram_bytes = 0
+        self.peak_ram_bytes = 0
+        self.disk_bytes = 0
+        self.peak_disk_bytes = 0
+        self.dropped_rows = 0
+        self.shards_spilled = 0
+
+    def add(self, x, y):
+        self.entries.append([list(x), y, None])
+        self.num_rows += y.shape[0]
+        self.ram_bytes += entry_bytes(x, y)
+        self.peak_ram_bytes = max(self.peak_ram_bytes, self.ram_bytes)
+        if self.ram_bytes > self.ram_cap:
+            if self.drop_oldest:
+                while self.ram_bytes > self.ram_cap and len(self.entries) > 1:
+                    x, y, paths = self.entries.popleft()
+                    self.num_rows -= y.shape[0]
+                    self.ram_bytes -= entry_bytes(x, y)
+                    self.dropped_rows += y.shape[0]
+            else:
+                self.spill()
+
+    def spill(self):  #Write every entry in RAM to one shard on disk, replacing them with memmaps of it
+        in_ram = 0
+        while in_ram < len(self.entries) and self.entries[-1-in_ram][2] is None:
+            in_ram += 1
+        ram_entries = [self.entries.pop() for i in range(in_ram)][::-1]
+        x = [np.concatenate([e[0][i] for e in ram_entries], axis=0) for i in range(len(ram_entries[0][0]))]
+        y = np.concatenate([e[1] for e in ram_entries], axis=0)
+
+        prefix = os.path.join(self.spill_dir, "shard_"+str(self.shards_spilled))
+        paths = [prefix+"_x"+str(i)+".npy" for i in range(len(x))] + [prefix+"_y.npy"]
+        for path, a in zip(paths, x + [y]):
+            np.save(path, a)
+        self.entries.append([[np.load(path, mmap_mode="r") for path in paths[:-1]], np.load(paths[-1], mmap_mode="r"), paths])
+        self.shards_spilled += 1
+
+        self.ram_bytes = 0
+        self.disk_bytes += entry_bytes(x, y)
+        self.peak_disk_bytes = max(self.peak_disk_bytes, self.disk_bytes)
+
+    def take(self, max_rows=None):  #Removes and returns up to max_rows of the oldest rows (all of them if None), as (x, y) in RAM
+        xs = []
+        ys = []
+        rows = 0
+        while len(self.entries) > 0 and (max_rows is None or rows < max_rows):
+            entry = self.entries[0]
+            x, y, paths = entry
+            n = y.shape[0] if max_rows is None else min(y.shape[0], max_rows-rows)
+            if n == y.shape[0]:
+                self.entries.popleft()
+                if paths is not None:  # The memmaps keep the data readable until they are released
+                    for path in paths:
+                        os.remove(path)
+            else:
+                entry[0] = [a[n:] for a in x]
+                entry[1] = y[n:]
+                x = [a[:n] for a in x]
+                y = y[:n]
+            if paths is None:
+                self.ram_bytes -= entry_bytes(x, y)
+            else:
+                self.disk_bytes -= entry_bytes(x, y)
+            xs += [x]
+            ys += [y]
+            rows += n
+        self.num_rows -= rows
+        if rows == 0:
+            return None
+        return [np.concatenate([x[i] for x in xs], axis=0) for i in range(len(xs[0]))], np.concatenate(ys, axis=0)
+
+    def stats(self):
+        return {"ram_bytes": self.ram_bytes, "peak_ram_bytes": self.peak_ram_bytes, "disk_bytes": self.disk_bytes,
+                "peak_disk_bytes": self.peak_disk_bytes, "shards_spilled": self.shards_spilled, "dropped_rows": self.dropped_rows}
+
+    def summary(self):
+        return ("%d rows held, RAM %d bytes (peak %d), disk %d bytes (peak %d) in %d shards spilled, %d rows dropped" %
+                (self.num_rows, self.ram_bytes, self.peak_ram_bytes, self.disk_bytes, self.peak_disk_bytes, self.shards_spilled, self.dropped_rows))
+
+    def close(self):
+        self.entries.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+def entry_bytes(x, y):
+    return sum(a.nbytes for a in x) + y.nbytes
@@ -0,0 +1,111 @@
+import random
+
+import numpy as np
+
+import game
+import train
+from vector_game import VectorCoupGame
+
+
+class RandomEvaluator:  # Stands in for a model, scoring every row uniformly at random
+    def __init__(self, width):
+        self.width = width
+
+    def predict(self, x, **kwargs):
+        return np.random.random((x[0].shape[0], self.width)).astype(np.float32)
+
+    def fit(self, x, y, **kwargs):
+        pass
+
+
+class RecordingWrapper(train.GameTrainingWrapper):  # Records the decisions made during a turn, and skips the hand predictor
+    def take_turn(self):
+        self.record = {}
+        return super().take_turn()
+
+    def update_hand_states(self, players, actions, targets, failed_to_block, resultant_hand_states):
+        if "action" not in self.record:
+            self.record["action"] = (actions, targets)
+
+    def decide_challenge(self, challenger, challengee, action, write_decision_to_training):
+        result = super().decide_challenge(challenger, challengee, action, write_decision_to_training)
+        self.record[("challenge", challenger)] = result
+        return result
+
+    def decide_block(self, blocker, blockee, action, write_decision_to_training):
+        result = super().decide_block(blocker, blockee, action, write_decision_to_training)
+        self.record[("block", blocker)] = result
+        return result
+
+    def decide_response(self, responder, aggressor, action):
+        result = super().decide_response(responder, aggressor, action)
+        self.record[("block", responder)], self.record[("challenge", responder)] = result
+        return result
+
+    def decide_communal_block(self, blockers, blockee, action):
+        result = super().decide_communal_block(blockers, blockee, action)
+        self.record["communal_block"] = result
+        return result
+
+    def decide_communal_challenge(self, challengers, challengee, action):
+        result = super().decide_communal_challenge(challengers, challengee, action)
+        self.record["communal_challenge"] = result
+        return result
+
+
+def check_against_scalar(num_games=64, seed=0):  # Plays seeded games through GameTrainingWrapper, replays each turn's decisions on a VectorCoupGame and checks both end in the same state
+    random.seed(seed)
+    np.random.seed(seed)
+    evaluators = [RandomEvaluator(1)] * 5 + [RandomEvaluator(5)]
+    wrappers = [RecordingWrapper(5, *evaluators, q_epsilon=.2, verbose=False) for _ in range(num_games)]
+    vector = VectorCoupGame(num_games, 5, seed=seed)
+    running = np.ones(num_games, dtype=bool)
+    turns = 0
+    while running.any():
+        decisions = np.full((6, num_games), -1, dtype=np.int64)  # action, target, blocker, block card, challenger, counter-challenge
+        for lane in np.flatnonzero(running):
+            w = wrappers[lane]
+            vector.set_game(lane, w.game)
+            tt = w.game.turn
+            running[lane] = w.take_turn()
+            action, target = w.record["action"]
+            blocker, block_card, challenger, counter = -1, -1, -1, False
+            if action == game.FOREIGN_AID and w.record["communal_block"][0]:
+                blocker = w.record["communal_block"][1]
+                counter = w.record[("challenge", tt)][0]
+            if action in (game.TAX, game.EXCHANGE) and w.record["communal_challenge"][0]:
+                challenger = w.record["communal_challenge"][1]
+            if action in game.TARGETING_BLOCKABLE_ACTIONS:
+                blocking_info, challenge_info = w.record[("block", target)], w.record[("challenge", target)]
+                if blocking_info[0] or challenge_info[0]:
+                    if (not challenge_info[0]) or blocking_info[1] > challenge_info[1]:
+                        blocker = target
+                        block_card = game.CAPTAIN if blocking_info[0] == 1 else game.AMBASSADOR
+                        counter = w.record[("challenge", tt)][0]
+                    else:
+                        challenger = target
+            decisions[:, lane] = action, target, blocker, block_card, challenger, counter
+
+        stepped = decisions[0] >= 0
+        finished = vector.resolve_turn(*decisions)
+        for lane in np.flatnonzero(stepped):
+            g = wrappers[lane].game
+            expected_lengths = [len(h) for h in g.hands]
+            assert (vector.hand_lengths[lane] == expected_lengths).all(), (lane, "hand sizes")
+            assert (vector.player_coins[lane] == g.player_coins).all(), (lane, "coins")
+            assert (vector.discard_counts[lane] == game.count_cards(g.discards)).all(), (lane, "discards")
+            assert vector.turn[lane] == g.turn, (lane, "turn")
+            assert finished[lane] == (not running[lane]), (lane, "game over")
+            for p in np.flatnonzero(~vector.last_drawn[lane]):  # Anyone who drew may hold different (but equally likely) cards
+                assert list(vector.hand_slots[lane, p, :expected_lengths[p]]) == g.hands[p], (lane, p, "hand")
+            assert ((vector.deck_counts[lane] + vector.hand_counts[lane].sum(axis=0) + vector.discard_counts[lane]) == 3).all(), (lane, "card count")
+            turns += 1
+    return turns
+
+
+def test_matches_scalar_engine():
+    assert check_against_scalar(64, 0) > 0
+
+
+def test_matches_scalar_engine_other_seed():
+    assert check_against_scalar(16, 1) > 0
@@ -1,15 +1,17 @@
 import game
 import numpy as np
-from random import random, shuffle, randrange
+from communication import BroadcastBatch
+from random import random, randrange
+from collections import namedtuple
 
 
 
 
 
-def row_to_first(arr,row): #Given a given index in a numpy array, return a copy of the array with that index first (moving all between it and first in the process)
+def roll_to_first(arr,row):
     return np.roll(arr,-row, axis=0)
 
-def rows_to_first_second(arr, row1, row2):
+def roll_to_first_second(arr, row1, row2):
     cycle = (5**row1)*(7**row2) % (arr.shape[0]-2)
     rows = (row1, row2) if row1<row2 else (row2, row1)
     return np.concatenate([arr[row1:row1+1],
@@ -17,53 +19,112 @@ def rows_to_first_second(arr, row1, row2):
                            np.roll(np.concatenate([arr[:rows[0]], arr[rows[0]+1:rows[1]], arr[rows[1]+1:]], axis=0), cycle, axis=0),
                            ], axis=0)
 
+# Every seat reordering used above, worked out once: FIRST_PERMUTATIONS[row] and FIRST_SECOND_PERMUTATIONS[row1, row2] index a per-player array into that order (the diagonal of the latter is unused)
+FIRST_PERMUTATIONS = np.array([roll_to_first(np.arange(game.MAX_PLAYERS), row) for row in range (game.MAX_PLAYERS)])
+FIRST_SECOND_PERMUTATIONS = np.array([[roll_to_first_second(np.arange(game.MAX_PLAYERS), row1, row2) if row1!=row2 else np.arange(game.MAX_PLAYERS)
+                                       for row2 in range (game.MAX_PLAYERS)] for row1 in range (game.MAX_PLAYERS)])
+
+def row_to_first(arr,row): #Given a given index in a numpy array, return a copy of the array with that index first (moving all between it and first in the process)
+    if arr.shape[0]==game.MAX_PLAYERS:
+        return arr[FIRST_PERMUTATIONS[row]]
+    return roll_to_first(arr,row)
+
+def rows_to_first_second(arr, row1, row2):
+    if arr.shape[0]==game.MAX_PLAYERS and row1!=row2:
+        return arr[FIRST_SECOND_PERMUTATIONS[row1, row2]]
+    return roll_to_first_second(arr, row1, row2)
+
+def gather_rows(arr, permutations, out=None): #Reorders a per-player array once for each row of permutations (e.g. FIRST_PERMUTATIONS[players]), in a single gather
+    return np.take(arr, permutations, axis=0, out=out)
+
 
 def zero_axis_tile(arr,num): #Gives an array of num elements, each of whose elements is a copy of the given array. Useful for expanding repeated training data
     return np.repeat(np.expand_dims(arr,axis=0), num, axis=0)
 
-def append_slice(arr,slice):
-    return np.append(arr, np.expand_dims(slice,axis=0), axis=0)
-
 def one_hot(arr,num_cats):
     a=np.zeros((arr.shape[0],num_cats), dtype=np.float32)
-    a[np.arange(arr.shape[0]), arr.astype(np.int)]=1
+    a[np.arange(arr.shape[0]), arr.astype(np.int64)]=1
     return a
 
 
+def inputs_for(evaluator, inputs): #Broadcast batches go out as they are to evaluators that expand them on their side, and are expanded here for any other
+    if isinstance(inputs, BroadcastBatch) and not getattr(evaluator, "accepts_broadcast", False):
+        return inputs.expand()
+    return inputs
+
+def evaluate(evaluator, inputs):
+    return evaluator.predict(inputs_for(evaluator, inputs))
+
+def predict_async(evaluator, inputs): #Sends a request without waiting on it, where the evaluator supports that. Returns a function which waits for and returns the result
+    if getattr(evaluator, "predict_async", None) is not None:
+        return evaluator.predict_async(inputs_for(evaluator, inputs))
+    result = evaluate(evaluator, inputs)
+    return lambda: result
+
+
+class GrowableBuffer: #Rows stored in a preallocated array that doubles when full. Rows are only ever written once, so reads can hand out views
+    def __init__(self, initial_capacity=16):
+        self.initial_capacity = initial_capacity
+        self.data = None
+        self.start = 0
+        self.end = 0
+
+    def append(self, row):
+        row = np.asarray(row)
+        if self.data is None:
+            self.data = np.empty((self.initial_capacity,)+row.shape, dtype=row.dtype)
+        elif self.end == self.data.shape[0] or np.result_type(self.data.dtype, row.dtype) != self.data.dtype: #Full, or the row needs a wider dtype (as np.append would promote to)
+            grown = np.empty((max(self.initial_capacity, 2*len(self)),)+self.data.shape[1:], dtype=np.result_type(self.data.dtype, row.dtype))
+            grown[:len(self)] = self.data[self.start:self.end]
+            self.data = grown
+            self.end -= self.start
+            self.start = 0
+        self.data[self.end] = row
+        self.end += 1
+
+    def take(self, num): #Removes the first num rows, returning them as a view
+        rows = self.data[self.start:self.start+num]
+        self.start += num
+        return rows
+
+    def nbytes(self):
+        return 0 if self.data is None else self.data.nbytes
+
+    def __len__(self):
+        return self.end-self.start
+
 
 class ActionEvaluatorQueue: #This allows us to give action evaluation inputs and desired outputs at separate times
     def __init__(self):
         self.inputs = None
-        self.output = None
+        self.output = GrowableBuffer()
+        self.peak_nbytes = 0
     def append_inputs(self, inputs):
-        if type(self.inputs)==type(None):
-            self.inputs = [np.expand_dims(x,axis=0) for x in list(inputs)]
-        else:
-            self.inputs = [append_slice(self.inputs[i],inputs[i]) for i in range (0,len(inputs))]
+        if self.inputs is None:
+            self.inputs = [GrowableBuffer() for x in inputs]
+        for i in range (0,len(inputs)):
+            self.inputs[i].append(inputs[i])
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes())
     def append_output(self, output):
-        if type(self.output)==type(None):
-            self.output = np.expand_dims(output, axis=0)
-        else:
-            self.output = append_slice(self.output,output)
+        self.output.append(output)
+        self.peak_nbytes = max(self.peak_nbytes, self.nbytes())
 
     def num_inputs(self):
-        if type(self.inputs)==type(None):
+        if self.inputs is None:
             return 0
-        return self.inputs[0].shape[0]
+        return len(self.inputs[0])
     def num_outputs(self):
-        if type(self.output)==type(None):
-            return 0
-        return self.output.shape[0]
+        return len(self.output)
 
-    def read_complete_data(self):
-        if type(self.output)==type(None):
+    def nbytes(self):
+        return self.output.nbytes() + (0 if self.inputs is None else sum(i.nbytes() for i in self.inputs))
+
+    def read_complete_data(self): #Returns views of every input with a known output, and drops them from the queue
+        num_valid = self.num_outputs()
+        if num_valid == 0:
             return -1
-        num_valid = self.output.shape[0]
-        assert self.inputs[0].shape[0] >= num_valid
-        rets = ([i[0:num_valid] for i in self.inputs], self.output[0:num_valid])
-        self.inputs=self.inputs[num_valid:]
-        self.output=None
-        return rets
+        assert self.num_inputs() >= num_valid
+        return ([i.take(num_valid) for i in self.inputs], self.output.take(num_valid))
 
 def combine_ready_from_list(queue_list):
     read=[x.read_complete_data() for x in queue_list]
@@ -86,9 +147,14 @@ def combine_ready_from_list(queue_list):
     return concatenated_inputs, np.concatenate([x[1] for x in read], axis=0)
 
 
+# Everything about a pending decision that doesn't need the evaluator: its inputs for every option, and the option picked if we explore at random (None if we ask the evaluator)
+ChallengeContext = namedtuple("ChallengeContext", ["challenger", "evaluator", "shared_inputs", "random_choice"])
+BlockContext = namedtuple("BlockContext", ["blocker", "evaluator", "data_queue", "is_captain", "shared_inputs", "options", "random_choice"])
+
+
 class GameTrainingWrapper:
-    def __init__(self, num_players, action_evaluator, assassin_block_evaluator, aid_block_evaluator, captain_block_evaluator, challenge_evaluator, hand_predictor, q_epsilon, verbose):
-        self.game = game.CoupGame(num_players)
+    def __init__(self, num_players, action_evaluator, assassin_block_evaluator, aid_block_evaluator, captain_block_evaluator, challenge_evaluator, hand_predictor, q_epsilon, verbose, compact_state=False, defer_hand_updates=False, trajectory_writer=None):
+        self.game = game.CompactCoupGame(num_players) if compact_state else game.CoupGame(num_players)
 
         self.action_evaluator = action_evaluator
         self.assassin_block_evaluator = assassin_block_evaluator
@@ -121,6 +187,18 @@ class GameTrainingWrapper:
 
         self.predicted_hand_states = np.full((game.MAX_PLAYERS, 5), .4, dtype=np.float32)
 
+        self.defer_hand_updates = defer_hand_updates  # If set, hand-state updates are held until the beliefs are next read, and their training data sent together
+        self.pending_hand_updates = []
+
+        self.trajectory_writer = trajectory_writer  # A trajectories.ShardWriter, which is given all training data as it is sent
+
+    def log_training_data(self, model_index, x, y): #Model indices are those of models.build_model
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.add(model_index, x, y)
+
+    def queue_memory_high_water(self): #Peak bytes held by this game's training queues
+        return sum(q.peak_nbytes for qset in self.all_data_queues for q in qset)
+
     def print_game_state(self):
         print ("Raw hands:", self.game.hands)
         print ("Hands: ", [game.cards_to_names(i) for i in self.game.hands])
@@ -135,20 +213,39 @@ class GameTrainingWrapper:
             resultant_hand_states = [resultant_hand_states]
             failed_to_block = [failed_to_block]
 
+        update = (players, actions, targets, failed_to_block, resultant_hand_states,
+                  self.game.count_inplay(), self.game.hand_sizes(), self.game.player_coins.copy() if self.defer_hand_updates else self.game.player_coins)  # Coins change in place, so only a deferred update needs its own copy
+
+        if self.defer_hand_updates:  # Only the game state is captured now. The priors are filled in at the flush, from the predictions of the updates before this one
+            self.pending_hand_updates += [update]
+            return
+
+        input, outputs = self.hand_update_data(update)
+        self.log_training_data(5, input, outputs)
+
+        if not (getattr(self.hand_predictor, "fit_predict", None) is None):  # If we have access to fit_predict, it saves time
+            results = self.hand_predictor.fit_predict(input, outputs, axis=0)
+        else:
+            results = self.hand_predictor.predict(input)
+            self.hand_predictor.fit(input, outputs, epochs=1)
+
+        for i in range (len(players)):
+            self.predicted_hand_states[players[i]] = results[i]
+
+    def hand_update_data(self, update): #Hand predictor inputs and training targets for one update, using the current beliefs as priors
+        players, actions, targets, failed_to_block, resultant_hand_states, count_inplay, hand_sizes, player_coins = update
         num_actions = len(players)
 
 
-        nondiscarded_cards = zero_axis_tile(self.game.count_inplay(), num_actions)
+        nondiscarded_cards = zero_axis_tile(count_inplay, num_actions)
 
-        prior_probabilities = zero_axis_tile(self.predicted_hand_states, num_actions)
-        num_cards = zero_axis_tile(self.game.hand_sizes(), num_actions)
-        num_coins = zero_axis_tile(self.game.player_coins, num_actions)
+        permutations = FIRST_PERMUTATIONS[players]
+        prior_probabilities = gather_rows(self.predicted_hand_states, permutations)
+        num_cards = gather_rows(hand_sizes, permutations)
+        num_coins = gather_rows(player_coins, permutations)
         action_array = one_hot(np.array(actions), game.NUM_ACTIONS)
         target_array = np.zeros((num_actions, game.MAX_PLAYERS-1), dtype=np.float32)
         for i in range (num_actions):
-            prior_probabilities[i] = row_to_first(prior_probabilities[i], players[i])
-            num_cards[i] = row_to_first(num_cards[i], players[i])
-            num_coins[i] = row_to_first(num_coins[i], players[i])
             if failed_to_block[i]:
                 action_array[i] = -action_array[i]
             if targets[i] != -1:
@@ -157,12 +254,6 @@ class GameTrainingWrapper:
             else:
                 target_array[i:i+1] = np.zeros((1, game.MAX_PLAYERS - 1), dtype=np.float32)
 
-
-
-
-
-
-
         input = [
             nondiscarded_cards,
             prior_probabilities,
@@ -173,21 +264,31 @@ class GameTrainingWrapper:
         ]
 
         outputs = np.concatenate([np.expand_dims(s, axis=0) for s in resultant_hand_states], axis=0)
-
-
-        if not (getattr(self.hand_predictor, "fit_predict", None) is None):  # If we have access to fit_predict, it saves time
-            results = self.hand_predictor.fit_predict(input, outputs, axis=0)
-        else:
-            results = self.hand_predictor.predict(input)
-            self.hand_predictor.fit(input, outputs, epochs=1)
-
-        for i in range (num_actions):
-            self.predicted_hand_states[players[i]] = results[i]
-
-
-
-
-    def decide_challenge(self, challenger, challengee, action, write_decision_to_training):
+        return input, outputs
+
+    def flush_hand_updates(self, skip_last=False): #Runs any deferred hand-state updates in order, then submits all their training data at once. skip_last drops the final prediction, for when nothing will read it
+        if len(self.pending_hand_updates) == 0:
+            return
+        inputs = []
+        outputs = []
+        for k in range (len(self.pending_hand_updates)):
+            update = self.pending_hand_updates[k]
+            input, output = self.hand_update_data(update)
+            if k < len(self.pending_hand_updates)-1 or not skip_last:
+                results = self.hand_predictor.predict(input)
+                for i in range (len(update[0])):
+                    self.predicted_hand_states[update[0][i]] = results[i]
+            inputs += [input]
+            outputs += [output]
+        self.pending_hand_updates = []
+        inputs = [np.concatenate([x[i] for x in inputs], axis=0) for i in range (len(inputs[0]))]
+        outputs = np.concatenate(outputs, axis=0)
+        self.log_training_data(5, inputs, outputs)
+        self.hand_predictor.fit(inputs, outputs, epochs=1)
+
+
+    def challenge_context(self, challenger, challengee, action): #Everything about a challenge decision that doesn't need the evaluator, including whether we explore at random
+        self.flush_hand_updates()
 
         nondiscarded_cards = self.game.count_inplay()
 
@@ -203,46 +304,54 @@ class GameTrainingWrapper:
         challengable_action = np.zeros((game.NUM_CHALLENGABLE_ACTIONS,))
         challengable_action[game.CHALLENGABLE_ACTIONS.index(action)]=1
 
-        if random() > self.q_epsilon:
-            predicted_values = self.challenge_evaluator.predict([
-                zero_axis_tile(nondiscarded_cards, 2),
-                zero_axis_tile(challenger_cards, 2),
-                zero_axis_tile(prior_probability, 2),
-                zero_axis_tile(num_cards, 2),
-                zero_axis_tile(num_coins, 2),
-                zero_axis_tile(noise, 2),
-                zero_axis_tile(challengable_action, 2),
-                np.array([[0],[1]], dtype=np.float32),
-            ]).flatten()
+        random_choice = None if random() > self.q_epsilon else randrange(2)
+
+        return ChallengeContext(challenger, self.challenge_evaluator,
+                                [nondiscarded_cards, challenger_cards, prior_probability, num_cards, num_coins, noise, challengable_action],
+                                random_choice)
+
+    def challenge_inputs(self, context):
+        return BroadcastBatch.single(context.shared_inputs, [np.array([[0],[1]], dtype=np.float32)])
+
+    def finish_challenge(self, context, predicted_values, write_decision_to_training): #Turns the evaluator's output (None if we explored at random) into a decision
+        if predicted_values is not None:
             #decision=np.random.choice(2,1,p=predicted_values/np.sum(predicted_values))[0]
             decision = np.argmax(predicted_values)
         else:
-            decision = randrange(2)
-
-
+            decision = context.random_choice
 
         if write_decision_to_training:
-            self.challenge_evaluation_data_queues[challenger].append_inputs((
-                nondiscarded_cards,
-                challenger_cards,
-                prior_probability,
-                num_cards,
-                num_coins,
-                noise,
-                challengable_action,
+            self.challenge_evaluation_data_queues[context.challenger].append_inputs(tuple(context.shared_inputs) + (
                 np.array([1 if decision else 0], dtype=np.float32),
             ))
 
         if self.verbose and decision>0:
-            print (challenger, "challenged" + ((" with expected value "+str(np.max(predicted_values))) if 'predicted_values' in vars() else "" ) )
-        return (decision, np.max(predicted_values) if 'predicted_values' in vars() else 0)
+            print (context.challenger, "challenged" + ((" with expected value "+str(np.max(predicted_values))) if predicted_values is not None else "" ) )
+        return (decision, np.max(predicted_values) if predicted_values is not None else 0)
+
+    def decide_challenge(self, challenger, challengee, action, write_decision_to_training):
+        context = self.challenge_context(challenger, challengee, action)
+        predicted_values = None
+        if context.random_choice is None:
+            predicted_values = evaluate(context.evaluator, self.challenge_inputs(context)).flatten()
+        return self.finish_challenge(context, predicted_values, write_decision_to_training)
+
+    def decide_response(self, responder, aggressor, action): #The target's block and challenge decisions for an assassination or steal. Both evaluator requests are sent before waiting on either
+        block_context = self.block_context(responder, aggressor, action)
+        challenge_context = self.challenge_context(responder, aggressor, action)
+        block_result = None if block_context.random_choice is not None else predict_async(block_context.evaluator, self.block_inputs(block_context))
+        challenge_result = None if challenge_context.random_choice is not None else predict_async(challenge_context.evaluator, self.challenge_inputs(challenge_context))
+        blocking_info = self.finish_block(block_context, None if block_result is None else block_result().flatten(), write_decision_to_training=True)
+        challenge_info = self.finish_challenge(challenge_context, None if challenge_result is None else challenge_result().flatten(), write_decision_to_training=True)
+        return (blocking_info, challenge_info)
 
     def decide_communal_challenge(self, challengers, challengee, action):
         poss_chal = randrange(0, len(challengers))
         result = self.decide_challenge(challengers[poss_chal], challengee, action, write_decision_to_training=True)[0]
         return (result, challengers[poss_chal])
 
-    def decide_block(self, blocker, blockee, action, write_decision_to_training):
+    def block_context(self, blocker, blockee, action): #Everything about a block decision that doesn't need the evaluator, including whether we explore at random
+        self.flush_hand_updates()
         blocker=int(blocker)
         blockee=int(blockee)
         is_captain=False
@@ -268,50 +377,60 @@ class GameTrainingWrapper:
 
         noise = np.random.normal(.5, .5, (5,)).astype(np.float32)
 
-        options = 3 if is_captain else 2
         option_array = np.array([[0,0],[1,0],[0,1]], dtype=np.float32) if is_captain else np.array([[0],[1]], dtype=np.float32)
 
-        if random()>self.q_epsilon:
-            predicted_values = evaluator.predict([
-                zero_axis_tile(nondiscarded_cards, options),
-                zero_axis_tile(blocker_cards, options),
-                zero_axis_tile(prior_probability, options),
-                zero_axis_tile(num_cards, options),
-                zero_axis_tile(num_coins, options),
-                zero_axis_tile(noise, options),
-                option_array,
-            ]).flatten()
+        random_choice = None if random()>self.q_epsilon else randrange(3 if is_captain else 2)
+
+        return BlockContext(blocker, evaluator, data_queue, is_captain,
+                            [nondiscarded_cards, blocker_cards, prior_probability, num_cards, num_coins, noise],
+                            option_array, random_choice)
+
+    def block_inputs(self, context):
+        return BroadcastBatch.single(context.shared_inputs, [context.options])
+
+    def finish_block(self, context, predicted_values, write_decision_to_training): #Turns the evaluator's output (None if we explored at random) into a decision
+        if predicted_values is not None:
             #decision_index = np.random.choice(3 if is_captain else 2, 1, p=predicted_values / np.sum(predicted_values))[0]
             decision_index = np.argmax(predicted_values)
         else:
-            decision_index = randrange(3 if is_captain else 2)
+            decision_index = context.random_choice
 
         decision=decision_index
-        if is_captain:
+        if context.is_captain:
             if decision_index==1:
                 decision=game.CAPTAIN
             if decision_index==2:
                 decision=game.AMBASSADOR
 
         if write_decision_to_training:
-            data_queue.append_inputs((
-                nondiscarded_cards,
-                blocker_cards,
-                prior_probability,
-                num_cards,
-                num_coins,
-                noise,
-                option_array[decision_index],
-            ))
+            context.data_queue.append_inputs(tuple(context.shared_inputs) + (context.options[decision_index],))
         if self.verbose and decision>0:
-            print (blocker, "blocked" + ((" with expected value "+str(np.max(predicted_values))) if 'predicted_values' in vars() else "" ) )
-        return (decision, np.max(predicted_values) if 'predicted_values' in vars() else 0)
+            print (context.blocker, "blocked" + ((" with expected value "+str(np.max(predicted_values))) if predicted_values is not None else "" ) )
+        return (decision, np.max(predicted_values) if predicted_values is not None else 0)
+
+    def decide_block(self, blocker, blockee, action, write_decision_to_training):
+        context = self.block_context(blocker, blockee, action)
+        predicted_values = None
+        if context.random_choice is None:
+            predicted_values = evaluate(context.evaluator, self.block_inputs(context)).flatten()
+        return self.finish_block(context, predicted_values, write_decision_to_training)
 
-    def decide_communal_block(self, blockers, blockee, action):
+    def decide_communal_block(self, blockers, blockee, action): #Every blocker's options go to the evaluator in a single call
         wv=self.verbose
         self.verbose=False
-        results = [self.decide_block(x, blockee, action, write_decision_to_training=True) for x in
-                   blockers]
+        contexts = [self.block_context(x, blockee, action) for x in blockers]
+        evaluated = [c for c in contexts if c.random_choice is None]
+        if len(evaluated) > 0:
+            inputs = BroadcastBatch.concatenate([self.block_inputs(c) for c in evaluated])
+            predicted_values = evaluate(evaluated[0].evaluator, inputs).flatten()
+        results = []
+        row = 0
+        for c in contexts:
+            if c.random_choice is None:
+                results += [self.finish_block(c, predicted_values[row:row+c.options.shape[0]], write_decision_to_training=True)]
+                row += c.options.shape[0]
+            else:
+                results += [self.finish_block(c, None, write_decision_to_training=True)]
         self.verbose=wv
         if (True in [x[0] for x in results]):  # If someone decided to challenge
             max_index = 0
@@ -333,10 +452,8 @@ class GameTrainingWrapper:
     #     self.game.hands[player]+=[self.game.draw_from_deck()]
 
     def lose_card(self, player):
-        if self.game.hands[player]!=[]:
-            c=self.game.hands[player].pop(0)
-            self.game.discards+=[c]
-
+        c=self.game.lose_card(player)
+        if c is not None:
             LOSS_BIAS=.3
             self.next_turn_q_biases[player]-=LOSS_BIAS  # Bias for losing a card
             for i in range (game.MAX_PLAYERS):
@@ -367,11 +484,7 @@ class GameTrainingWrapper:
         self.game.player_coins[actor] += stolen
 
     def exchange(self, actor): #Exchanges cards. Currently random.
-        self.game.hands[actor]+=[self.game.draw_from_deck(), self.game.draw_from_deck()]
-        shuffle(self.game.hands[actor])
-        self.game.deck+=[self.game.hands[actor].pop(0), self.game.hands[actor].pop(1)]
-        self.game.hands[actor]=self.game.hands[actor][:2]
-        self.game.shuffle()
+        self.game.exchange(actor)
 
 
 
@@ -402,18 +515,18 @@ class GameTrainingWrapper:
 
         num_options = action_inputs.shape[0]
 
-        inputs = [
-            zero_axis_tile(undiscarded_cards, num_options),
-            zero_axis_tile(turn_taker_cards, num_options),
-            zero_axis_tile(prior_probability, num_options),
-            zero_axis_tile(num_cards, num_options),
-            zero_axis_tile(num_coins, num_options),
-            zero_axis_tile(noise, num_options),
-
+        inputs = BroadcastBatch.single([
+            undiscarded_cards,
+            turn_taker_cards,
+            prior_probability,
+            num_cards,
+            num_coins,
+            noise,
+        ], [
             one_hot(action_inputs, game.NUM_ACTIVE_ACTIONS),
             one_hot(target_inputs, game.MAX_PLAYERS-1),
-        ]
-        predicted_rewards = self.action_evaluator.predict(inputs).flatten()
+        ])
+        predicted_rewards = evaluate(self.action_evaluator, inputs).flatten()
 
         # Choose the action for our next move.
         if random()>self.q_epsilon:
@@ -441,14 +554,13 @@ class GameTrainingWrapper:
         self.next_turn_q_biases[turn_taker] = 0
 
         # Append the inputs which gave our current action to the input stack. Output won't be known until next turn
-        self.action_evaluation_data_queues[turn_taker].append_inputs(
-            [x[choice_index] for x in inputs]
-        )
+        self.action_evaluation_data_queues[turn_taker].append_inputs(inputs.row(choice_index))
 
         self.update_hand_states(turn_taker, action, target if action in game.TARGETING_ACTIONS else -1, False,
                                 self.game.one_hot_hand(turn_taker))
 
         if self.verbose:
+            self.flush_hand_updates()
             print("\n")
             print("Turn:", turn_taker)
             print("Deck:", game.cards_to_names(self.game.deck))
@@ -547,8 +659,7 @@ class GameTrainingWrapper:
                 self.tax(turn_taker)
 
         if (action == game.ASSASSINATE):
-            blocking_info = self.decide_block(target, turn_taker, game.ASSASSINATE, write_decision_to_training=True)
-            challenge_info = self.decide_challenge(target, turn_taker, game.ASSASSINATE, write_decision_to_training=True)
+            blocking_info, challenge_info = self.decide_response(target, turn_taker, game.ASSASSINATE)
             if blocking_info[0] or challenge_info[0]:  # If we block or challenge
                 if (not challenge_info[0]) or blocking_info[1]>challenge_info[1]:  # If we decide to block:
                     self.game.player_coins[turn_taker] -= 3
@@ -590,8 +701,7 @@ class GameTrainingWrapper:
 
 
         if (action == game.STEAL):
-            blocking_info = self.decide_block(target, turn_taker, game.STEAL, write_decision_to_training=True)
-            challenge_info = self.decide_challenge(target, turn_taker, game.STEAL, write_decision_to_training=True)
+            blocking_info, challenge_info = self.decide_response(target, turn_taker, game.STEAL)
 
             if blocking_info[0] or challenge_info[0]:
                 if (not challenge_info[0]) or blocking_info[1]>challenge_info[1]:  # If we decide to block:
@@ -644,9 +754,14 @@ class GameTrainingWrapper:
                                         [True, True],
                                         [self.game.one_hot_hand(target), self.game.one_hot_hand(target)])
 
+        # Run the hand-state updates still pending. The last prediction is skipped when nothing will read it: the game is over, or everyone it updates is out (their beliefs are zeroed below)
+        if len(self.pending_hand_updates) > 0:
+            last_players = self.pending_hand_updates[-1][0]
+            self.flush_hand_updates(skip_last=len(self.game.players_in()) <= 1 or not any(self.game.is_alive(p) for p in last_players))
+
         players_alive=0
         for i in range (self.game.num_players):  # Fill in 0s for rewards for any eliminated players, and set their attributes to 0
-            if self.game.hands[i]==[]:
+            if not self.game.is_alive(i):
                 for queue_type in self.all_data_queues:
                     while queue_type[i].num_outputs()<queue_type[i].num_inputs():
                         queue_type[i].append_output(np.array([0], dtype=np.float32))
@@ -663,7 +778,7 @@ class GameTrainingWrapper:
             return True
         else: #If the game is over, fill in 1s for rewards for any surviving players
             for i in range(self.game.num_players):
-                if self.game.hands[i] != []:
+                if self.game.is_alive(i):
                     for queue_type in self.all_data_queues:
                         while queue_type[i].num_outputs() < queue_type[i].num_inputs():
                             queue_type[i].append_output(np.array([1], dtype=np.float32))
@@ -671,14 +786,15 @@ class GameTrainingWrapper:
                         print ("Player", i, "won")
             return False
 
-    def train_evaluator(self, data_queue_list, evaluator, verbose):
+    def train_evaluator(self, data_queue_list, evaluator, verbose, model_index):
         data=combine_ready_from_list(data_queue_list)
         if data!=-1:
+            self.log_training_data(model_index, data[0], data[1])
             evaluator.fit(x=data[0], y=data[1], batch_size=32, epochs=1, verbose=verbose)
     def train_all_evaluators(self, verbose=0):
-        self.train_evaluator(self.action_evaluation_data_queues, self.action_evaluator, verbose)
-        self.train_evaluator(self.assassin_block_evaluation_data_queues, self.assassin_block_evaluator, verbose)
-        self.train_evaluator(self.captain_block_evaluation_data_queues, self.captain_block_evaluator, verbose)
-        self.train_evaluator(self.aid_block_evaluation_data_queues, self.aid_block_evaluator, verbose)
-        self.train_evaluator(self.challenge_evaluation_data_queues, self.challenge_evaluator, verbose)
-        self.train_evaluator(self.hand_predictor_data_queues, self.hand_predictor, verbose)
+        self.train_evaluator(self.action_evaluation_data_queues, self.action_evaluator, verbose, 0)
+        self.train_evaluator(self.assassin_block_evaluation_data_queues, self.assassin_block_evaluator, verbose, 1)
+        self.train_evaluator(self.captain_block_evaluation_data_queues, self.captain_block_evaluator, verbose, 3)
+        self.train_evaluator(self.aid_block_evaluation_data_queues, self.aid_block_evaluator, verbose, 2)
+        self.train_evaluator(self.challenge_evaluation_data_queues, self.challenge_evaluator, verbose, 4)
+        self.train_evaluator(self.hand_predictor_data_queues, self.hand_predictor, verbose, 5)
@@ -0,0 +1,118 @@
+import os
+import json
+import glob
+import queue
+import threading
+from time import time
+
+import numpy as np
+
+# Self-play decisions, logged as the training rows each model was sent: the inputs built for the decision (observation and chosen option), and the reward back-filled by take_turn.
+# Each worker writes its own compressed .npz shards and its own index_<worker>.jsonl, so workers never share a file. A shard is only listed in an index once it is complete.
+
+
+class ShardWriter:
+    def __init__(self, directory, worker, rows_per_shard=1<<15):
+        self.directory = directory
+        self.worker = worker
+        self.rows_per_shard = rows_per_shard
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index_"+str(worker)+".jsonl")
+        self.pending = {}  # Model index: [list of input lists, list of targets, rows]
+        self.shards_written = 0
+        self.rows_written = 0
+
+    def add(self, model_index, x, y):
+        if model_index not in self.pending:
+            self.pending[model_index] = [[], [], 0]
+        pending = self.pending[model_index]
+        pending[0] += [x]
+        pending[1] += [y]
+        pending[2] += y.shape[0]
+        if pending[2] >= self.rows_per_shard:
+            self.write_shard(model_index)
+
+    def write_shard(self, model_index):
+        xs, ys, rows = self.pending.pop(model_index)
+        arrays = {"x"+str(i): np.concatenate([x[i] for x in xs], axis=0) for i in range(len(xs[0]))}
+        arrays["y"] = np.concatenate(ys, axis=0)
+        name = "worker_"+str(self.worker)+"_model_"+str(model_index)+"_shard_"+str(self.shards_written)+".npz"
+        np.savez_compressed(os.path.join(self.directory, name+".tmp.npz"), **arrays)
+        os.replace(os.path.join(self.directory, name+".tmp.npz"), os.path.join(self.directory, name))
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps({"file": name, "model": model_index, "rows": rows, "inputs": len(xs[0]), "worker": self.worker, "time": time()}) + "\n")
+        self.shards_written += 1
+        self.rows_written += rows
+
+    def close(self):  #Writes out every partial shard
+        for model_index in list(self.pending):
+            self.write_shard(model_index)
+
+
+def read_index(directory, model_index=None):  #Every complete shard in directory, optionally only those for one model
+    entries = []
+    for path in sorted(glob.glob(os.path.join(directory, "index_*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    if model_index is None or entry["model"] == model_index:
+                        entries += [entry]
+    return entries
+
+
+def load_shard(directory, entry):
+    with np.load(os.path.join(directory, entry["file"])) as f:
+        return [f["x"+str(i)] for i in range(entry["inputs"])], f["y"]
+
+
+def stream_batches(directory, model_index, batch_size, epochs=1, num_threads=4, prefetch_shards=8, shuffle=True, seed=None):
+    # Yields (x, y) minibatches of one model's rows from every shard, for epochs passes. Reader threads load and decompress shards ahead of training, holding up to prefetch_shards in memory.
+    # With shuffle, shards are read in a random order and rows shuffled within each one. Shards finish loading in any order, so batches are not reproducible across runs
+    entries = read_index(directory, model_index)
+    rng = np.random.RandomState(seed)
+    work = queue.Queue()
+    for epoch in range(epochs):
+        for i in (rng.permutation(len(entries)) if shuffle else range(len(entries))):
+            work.put(entries[i])
+    for i in range(num_threads):
+        work.put(None)
+    loaded = queue.Queue(maxsize=prefetch_shards)
+
+    def reader():
+        try:
+            while 1:
+                entry = work.get()
+                if entry is None:
+                    return
+                loaded.put(load_shard(directory, entry))  # Decompression releases the GIL, so readers overlap with training
+        except Exception as e:  # A corrupt or missing shard: the consumer raises it
+            loaded.put(e)
+        finally:
+            loaded.put(None)
+    for i in range(num_threads):
+        threading.Thread(target=reader, daemon=True).start()
+
+    carry = None  # Rows left over from the last shard, which start the next batch
+    finished = 0
+    while finished < num_threads:
+        item = loaded.get()
+        if item is None:
+            finished += 1
+            continue
+        if isinstance(item, Exception):
+            raise item
+        x, y = item
+        if carry is not None:
+            x = [np.concatenate([c, a], axis=0) for c, a in zip(carry[0], x)]
+            y = np.concatenate([carry[1], y], axis=0)
+        if shuffle:
+            order = rng.permutation(y.shape[0])
+            x = [a[order] for a in x]
+            y = y[order]
+        full = y.shape[0] - y.shape[0] % batch_size
+        for start in range(0, full, batch_size):
+            yield [a[start:start+batch_size] for a in x], y[start:start+batch_size]
+        carry = ([a[full:] for a in x], y[full:]) if full < y.shape[0] else None
+    if carry is not None:
+        yield carry
@@ -0,0 +1,234 @@
+import numpy as np
+
+import game
+
+
+class VectorCoupGame:  # Holds num_games independent games as structure-of-arrays and steps them all at once. Rules follow GameTrainingWrapper.take_turn
+    def __init__(self, num_games, num_players, seed=None):
+        self.num_games = num_games
+        self.num_players = num_players
+        self.rng = np.random.RandomState(seed)
+        self.lanes = np.arange(num_games)
+
+        self.deck_counts = np.full((num_games, 5), 3, dtype=np.int8)
+        self.discard_counts = np.zeros((num_games, 5), dtype=np.int8)
+        self.hand_slots = np.full((num_games, game.MAX_PLAYERS, 2), -1, dtype=np.int8)  # Cards in hand order, -1 for an empty slot
+        self.hand_lengths = np.zeros((num_games, game.MAX_PLAYERS), dtype=np.int8)
+        self.hand_counts = np.zeros((num_games, game.MAX_PLAYERS, 5), dtype=np.int8)
+        self.player_coins = np.zeros((num_games, game.MAX_PLAYERS), dtype=np.float32)
+        self.player_coins[:, :num_players] = 2
+        self.turn = np.zeros(num_games, dtype=np.int64)
+        self.last_drawn = np.zeros((num_games, game.MAX_PLAYERS), dtype=bool)  # Which players drew from the deck during the last resolved turn
+
+        for p in range(num_players):
+            for _ in range(2):
+                self.add_to_hand(self.lanes, np.full(num_games, p), self.draw(self.lanes))
+
+    def set_game(self, lane, g):  # Copies the state of a scalar CoupGame/CompactCoupGame into one lane
+        self.deck_counts[lane] = game.count_cards(g.deck)
+        self.discard_counts[lane] = game.count_cards(g.discards)
+        self.hand_slots[lane] = -1
+        for p, hand in enumerate(g.hands):
+            self.hand_slots[lane, p, :len(hand)] = hand
+            self.hand_lengths[lane, p] = len(hand)
+            self.hand_counts[lane, p] = game.count_cards(hand)
+        self.player_coins[lane] = g.player_coins
+        self.turn[lane] = g.turn
+
+    # Batched views of the quantities the scalar game exposes
+
+    def alive(self):
+        return self.hand_lengths > 0
+
+    def count_discards(self):
+        return self.discard_counts.astype(np.float32)
+
+    def count_inplay(self):
+        return 3 - self.count_discards()
+
+    def one_hot_hands(self):
+        return self.hand_counts.astype(np.float32)
+
+    def hand_sizes(self):
+        return self.hand_lengths.astype(np.float32)
+
+    def finished(self):
+        return self.alive().sum(axis=1) <= 1
+
+    # Card movement. Every method takes an array of distinct lanes, along with the player (and card) to act on in each
+
+    def draw(self, lanes):  # Every card left in a lane's deck is equally likely
+        counts = self.deck_counts[lanes]
+        r = (self.rng.random_sample(len(lanes)) * counts.sum(axis=1)).astype(np.int64)
+        cards = (r[:, None] >= np.cumsum(counts, axis=1)).sum(axis=1)
+        self.deck_counts[lanes, cards] -= 1
+        return cards
+
+    def add_to_hand(self, lanes, players, cards):
+        self.hand_slots[lanes, players, self.hand_lengths[lanes, players]] = cards
+        self.hand_lengths[lanes, players] += 1
+        self.hand_counts[lanes, players, cards] += 1
+
+    def remove_from_hand(self, lanes, players, slots):
+        cards = self.hand_slots[lanes, players, slots].astype(np.int64)
+        self.hand_slots[lanes, players, 0] = np.where(slots == 0, self.hand_slots[lanes, players, 1], self.hand_slots[lanes, players, 0])
+        self.hand_slots[lanes, players, 1] = -1
+        self.hand_lengths[lanes, players] -= 1
+        self.hand_counts[lanes, players, cards] -= 1
+        return cards
+
+    def has_card(self, players, cards):  # Over all lanes
+        return self.hand_counts[self.lanes, players, cards] > 0
+
+    def lose_card(self, lanes, players):
+        has_cards = self.hand_lengths[lanes, players] > 0
+        lanes, players = lanes[has_cards], players[has_cards]
+        cards = self.remove_from_hand(lanes, players, np.zeros(len(lanes), dtype=np.int64))
+        self.discard_counts[lanes, cards] += 1
+
+    def replace(self, lanes, players, cards):
+        cards = np.broadcast_to(cards, lanes.shape)
+        slots = (self.hand_slots[lanes, players, 0] != cards).astype(np.int64)
+        self.remove_from_hand(lanes, players, slots)
+        self.deck_counts[lanes, cards] += 1
+        self.add_to_hand(lanes, players, self.draw(lanes))
+        self.last_drawn[lanes, players] = True
+
+    def exchange(self, lanes, players):  # Same procedure as CoupGame.exchange: draw two, shuffle, return the first and third
+        rows = np.arange(len(lanes))
+        lengths = self.hand_lengths[lanes, players].astype(np.int64)
+        pool = np.full((len(lanes), 4), -1, dtype=np.int64)
+        pool[:, :2] = self.hand_slots[lanes, players]
+        pool[rows, lengths] = self.draw(lanes)
+        pool[rows, lengths + 1] = self.draw(lanes)
+        keys = self.rng.random_sample(pool.shape)
+        keys[pool < 0] = 2  # Empty entries sort last
+        pool = np.take_along_axis(pool, np.argsort(keys, axis=1), axis=1)
+
+        self.deck_counts[lanes, pool[:, 0]] += 1
+        self.deck_counts[lanes, pool[:, 2]] += 1
+        self.hand_slots[lanes, players] = -1
+        self.hand_lengths[lanes, players] = 0
+        self.hand_counts[lanes, players] = 0
+        self.add_to_hand(lanes, players, pool[:, 1])
+        kept_two = pool[:, 3] >= 0
+        self.add_to_hand(lanes[kept_two], players[kept_two], pool[kept_two, 3])
+        self.last_drawn[lanes, players] = True
+
+    def steal(self, lanes, actors, targets):
+        stolen = np.minimum(self.player_coins[lanes, targets], 2)
+        self.player_coins[lanes, targets] -= stolen
+        self.player_coins[lanes, actors] += stolen
+
+    def resolve_turn(self, action, target, blocker, block_card, challenger, counter_challenge):
+        # All arguments have one entry per lane, and hold the decisions made for the current turn-taker's action:
+        #   action, target: the active action and its (absolute) target, target ignored for untargeted actions
+        #   blocker: who blocked, or -1. For assassinate/steal this is the target, when they chose to block over challenging
+        #   block_card: the card claimed to block a steal (game.CAPTAIN or game.AMBASSADOR)
+        #   challenger: who challenged the action itself, or -1
+        #   counter_challenge: whether the turn-taker challenged the block
+        # Finished lanes are left alone. Returns which lanes are finished after the turn.
+        action = np.asarray(action)
+        target = np.asarray(target)
+        blocker = np.asarray(blocker)
+        block_card = np.maximum(np.asarray(block_card), 0)
+        challenger = np.asarray(challenger)
+        counter_challenge = np.asarray(counter_challenge, dtype=bool)
+
+        live = ~self.finished()
+        tt = self.turn
+        blocked = blocker >= 0
+        challenged = challenger >= 0
+        self.last_drawn[:] = False
+
+        def where(mask):
+            return self.lanes[live & mask]
+
+        g = where(action == game.COUP)
+        self.player_coins[g, tt[g]] -= 7
+        self.lose_card(g, target[g])
+
+        g = where(action == game.INCOME)
+        self.player_coins[g, tt[g]] += 1
+
+        aid = action == game.FOREIGN_AID
+        g = where(aid & ~blocked)
+        self.player_coins[g, tt[g]] += 2
+        contested = aid & blocked & counter_challenge
+        had_duke = self.has_card(blocker, game.DUKE)
+        g = where(contested & had_duke)
+        self.lose_card(g, tt[g])
+        self.replace(g, blocker[g], game.DUKE)
+        g = where(contested & ~had_duke)
+        self.lose_card(g, blocker[g])
+        self.player_coins[g, tt[g]] += 2
+
+        exchange = action == game.EXCHANGE
+        had_ambassador = self.has_card(tt, game.AMBASSADOR)
+        g = where(exchange & challenged & had_ambassador)
+        self.lose_card(g, challenger[g])
+        self.replace(g, tt[g], game.AMBASSADOR)
+        self.exchange(g, tt[g])
+        g = where(exchange & challenged & ~had_ambassador)
+        self.lose_card(g, tt[g])
+        g = where(exchange & ~challenged)
+        self.exchange(g, tt[g])
+
+        tax = action == game.TAX
+        had_duke = self.has_card(tt, game.DUKE)
+        g = where(tax & challenged & had_duke)
+        self.lose_card(g, challenger[g])
+        self.replace(g, tt[g], game.DUKE)
+        self.player_coins[g, tt[g]] += 3
+        g = where(tax & challenged & ~had_duke)
+        self.lose_card(g, tt[g])
+        g = where(tax & ~challenged)
+        self.player_coins[g, tt[g]] += 3
+
+        assassinate = action == game.ASSASSINATE
+        g = where(assassinate & blocked)
+        self.player_coins[g, tt[g]] -= 3
+        had_contessa = self.has_card(target, game.CONTESSA)
+        g = where(assassinate & blocked & counter_challenge & had_contessa)
+        self.lose_card(g, tt[g])
+        self.replace(g, target[g], game.CONTESSA)
+        g = where(assassinate & blocked & counter_challenge & ~had_contessa)
+        self.lose_card(g, target[g])
+        self.lose_card(g, target[g])
+        had_assassin = self.has_card(tt, game.ASSASSIN)
+        g = where(assassinate & ~blocked & challenged & had_assassin)
+        self.lose_card(g, target[g])
+        self.player_coins[g, tt[g]] -= 3
+        self.lose_card(g, target[g])
+        self.replace(g, tt[g], game.ASSASSIN)
+        g = where(assassinate & ~blocked & challenged & ~had_assassin)
+        self.lose_card(g, tt[g])
+        g = where(assassinate & ~blocked & ~challenged)
+        self.player_coins[g, tt[g]] -= 3
+        self.lose_card(g, target[g])
+
+        steal = action == game.STEAL
+        had_block_card = self.has_card(target, block_card)
+        g = where(steal & blocked & counter_challenge & had_block_card)
+        self.lose_card(g, tt[g])
+        self.replace(g, target[g], block_card[g])
+        g = where(steal & blocked & counter_challenge & ~had_block_card)
+        self.lose_card(g, target[g])
+        self.steal(g, tt[g], target[g])
+        had_captain = self.has_card(tt, game.CAPTAIN)
+        g = where(steal & ~blocked & challenged & had_captain)
+        self.lose_card(g, target[g])
+        self.steal(g, tt[g], target[g])
+        self.replace(g, tt[g], game.CAPTAIN)
+        g = where(steal & ~blocked & challenged & ~had_captain)
+        self.lose_card(g, tt[g])
+        g = where(steal & ~blocked & ~challenged)
+        self.steal(g, tt[g], target[g])
+
+        # Eliminated players keep no coins, and the turn passes to the next player still in
+        self.player_coins[live[:, None] & ~self.alive()] = 0
+        g = self.lanes[live]
+        seats = (self.turn[g, None] + np.arange(1, game.MAX_PLAYERS + 1)) % game.MAX_PLAYERS
+        self.turn[g] = seats[np.arange(len(g)), np.argmax(self.alive()[g[:, None], seats], axis=1)]
+
+        return self.finished()